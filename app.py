@@ -1,16 +1,33 @@
 import dash
+import dash.exceptions
 import dash_core_components as dcc
 import dash_html_components as html
-import numpy as np
+import pandas as pd
 import plotly.graph_objects as go
 import flask
+import os
+import threading
+import time
+
+import metrics
 
 #from database import fetch_all_bpa_as_df
-from database import fetch_all_spotify_as_df
+from database import fetch_latest_spotify_dates
+from database import fetch_genre_daily_stats
+from database import fetch_spotify_as_df
+from database import fetch_spotify_regions
+from database import fetch_metrics
+from database import save_metrics
+from database import METRICS_PERIOD
+from database import SPOTIFY_REGIONS
+from figures import genre_box_traces
+from figure_cache import cached_figure
 
 # Definitions of constants. This projects uses extra CSS stylesheet at `./assets/style.css`
 COLORS = ['rgb(67,67,67)', 'rgb(115,115,115)', 'rgb(49,130,189)', 'rgb(189,189,189)','rgb(67,115,115)']
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css', '/assets/style.css']
+# chart region selected when the page opens, the first of the regions kept up to date
+DEFAULT_REGION = SPOTIFY_REGIONS[0]
 
 # Define the dash app first
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
@@ -199,35 +216,26 @@ def description():
         ''', className='eleven columns', style={'paddingLeft': '5%'})], className="row")
 
 
-def static_stacked_trend_graph(stack=False):
+@cached_figure('static_stacked_trend_graph')
+def static_stacked_trend_graph(region=DEFAULT_REGION, stack=False):
     """
-    Returns scatter line plot of all power sources and power load.
-    If `stack` is `True`, the 4 power sources are stacked together to show the overall power
-    production.
+    Returns the per-genre stream distribution of the latest week of charts of `region`.
+    If `stack` is `True`, the title is marked as stacked.
     """
     #df = fetch_all_bpa_as_df()
-    df = fetch_all_spotify_as_df()
-    if df is None:
+    date = fetch_latest_spotify_dates(6, region=region)
+    if len(date) == 0:
         return go.Figure() #empty figure initialized if no data in df
-    genres = df.genre.unique()
-    date = df.date.unique()
-    date = np.sort(date)
-    date = date[-6:]
-    df = df[df['date'].between(date[0], date[-1], inclusive = True)]
+    df = fetch_genre_daily_stats(date[0], date[-1], region=region)
+    if df is None:
+        df = fetch_spotify_as_df(date[0], date[-1], region=region)   # stats not built yet, box the raw rows
     #genres = genres[:5]
     #x = df['date']
-    fig = go.Figure()
-    for i, s in enumerate(genres):
-        df_by_genre = df[df['genre'] == s]
-        # fig.add_trace(go.Scatter(x=df_by_genre['date'], y=df_by_genre['Streams'], mode='markers', name=s,
-        #                          connectgaps=False,
-        #                          stackgroup='stack' if stack else None))
-        fig.add_trace(go.Box(x = df_by_genre['date'], y = df_by_genre['Streams'], name = s, 
-                             marker_color = COLORS[i%5]))
+    fig = go.Figure(data=genre_box_traces(df, x='date', colors=COLORS))
     
    # fig.add_trace(go.Scatter(x=x, y=df['Load'], mode='lines', name='Load',
                            #  line={'width': 2, 'color': 'orange'}))
-    title = 'Stream by genre across the week'
+    title = 'Stream by genre across the week ({})'.format(region.upper())
     if stack:
         title += ' [Stacked]'
 
@@ -269,7 +277,7 @@ def what_if_description(): #text descriptions
         # "What genres are on most streamed on Spotify's Top Tracks?"
         
         It might be interesting to zoom in on particular time points from the graph seen above. 
-        Enter one of the dates (yyyy-mm-dd) from the week shown above to check out how songs per genre distribute in the top 200 tracks for that day.
+        Pick one of the dates from the week shown above to check out how songs per genre distribute in the top 200 tracks for that day.
 
         ''', className='eleven columns', style={'paddingLeft': '5%'})
     ], className="row")
@@ -284,16 +292,16 @@ def what_if_tool():
         html.Div(children=[dcc.Graph(id='what-if-figure')], className='nine columns', style={'marginTop': '5rem'}),
 
         html.Div(children=[
-            html.H5("Rescale Power Supply", style={'marginTop': '2rem'}),
+            html.H5("Select a chart date", style={'marginTop': '2rem'}),
             html.Div(children = [
-                dcc.Input(
-            id="wind-scale-slider".format("wind-scale-slider"),
-            type='text',
-            placeholder="input date".format('wind-scale-slider')
+                dcc.DatePickerSingle(
+            id="what-if-date",
+            display_format='YYYY-MM-DD',
+            placeholder="input date"
             )], style={'marginTop': '3rem'}
             )]),
 
-        html.Div(id='wind-scale-text', className = 'three columns', style={'marginTop': '3rem'})
+        html.Div(id='what-if-date-text', className = 'three columns', style={'marginTop': '3rem'})
             
             ])
 
@@ -339,7 +347,22 @@ def architecture_summary():
     ], className='row')
 
 
-# Sequentially add page components to the app's layout
+def region_selector():
+    """
+    Returns the chart region dropdown as a dash `html.Div`; its options are filled by
+    `update_region_options`
+    """
+    return html.Div(children=[
+        html.H5('Chart region', className='two columns', style={'paddingLeft': '5%'}),
+        html.Div(children=[dcc.Dropdown(id='region', value=DEFAULT_REGION, clearable=False,
+                                        options=[{'label': DEFAULT_REGION.upper(),
+                                                  'value': DEFAULT_REGION}])],
+                 className='two columns'),
+    ], className='row')
+
+
+# Sequentially add page components to the app's layout. Building it reads no data: the trend
+# graph is filled by `update_trend_graph` once the page is shown
 def dynamic_layout():
     return html.Div([
         page_header(),
@@ -347,7 +370,8 @@ def dynamic_layout():
         html.Hr(),
         description(),
         # dcc.Graph(id='trend-graph', figure=static_stacked_trend_graph(stack=False)),
-        dcc.Graph(id='stacked-trend-graph', figure=static_stacked_trend_graph(stack=True)),
+        region_selector(),
+        dcc.Loading(dcc.Graph(id='stacked-trend-graph'), type='circle'),
         what_if_description(),
         what_if_tool(),
         architecture_summary(),
@@ -370,11 +394,53 @@ app.layout = serve_layout
 # Defines the dependencies of interactive components
 
 @app.callback(
-    dash.dependencies.Output('wind-scale-text', 'children'),
-    [dash.dependencies.Input('wind-scale-slider', 'value')])
+    dash.dependencies.Output('region', 'options'),
+    [dash.dependencies.Input('region', 'id')])
+@metrics.timed('callback.update_region_options')
+def update_region_options(_):
+    """Lists the regions with stored charts in the region dropdown"""
+    regions = fetch_spotify_regions()
+    if len(regions) == 0:
+        raise dash.exceptions.PreventUpdate
+    return [{'label': region.upper(), 'value': region} for region in regions]
+
+
+@app.callback(
+    dash.dependencies.Output('stacked-trend-graph', 'figure'),
+    [dash.dependencies.Input('region', 'value')])
+@metrics.timed('callback.update_trend_graph')
+def update_trend_graph(region):
+    """Fills the trend graph of the selected region, from the figure cache when possible"""
+    if not region:
+        raise dash.exceptions.PreventUpdate
+    return static_stacked_trend_graph(region, stack=True)
+
+
+@app.callback(
+    [dash.dependencies.Output('what-if-date', 'min_date_allowed'),
+     dash.dependencies.Output('what-if-date', 'max_date_allowed'),
+     dash.dependencies.Output('what-if-date', 'disabled_days'),
+     dash.dependencies.Output('what-if-date', 'date')],
+    [dash.dependencies.Input('region', 'value')])
+@metrics.timed('callback.update_what_if_dates')
+def update_what_if_dates(region):
+    """Limits the date picker to the chart dates stored for the selected region and selects the latest"""
+    if not region:
+        raise dash.exceptions.PreventUpdate
+    dates = pd.DatetimeIndex(fetch_latest_spotify_dates(region=region))
+    if len(dates) == 0:
+        raise dash.exceptions.PreventUpdate
+    disabled = pd.date_range(dates[0], dates[-1], freq='D').difference(dates)
+    return (dates[0].strftime('%Y-%m-%d'), dates[-1].strftime('%Y-%m-%d'),
+            [d.strftime('%Y-%m-%d') for d in disabled], dates[-1].strftime('%Y-%m-%d'))
+
+
+@app.callback(
+    dash.dependencies.Output('what-if-date-text', 'children'),
+    [dash.dependencies.Input('what-if-date', 'date')])
     
-def update_wind_sacle_text(value):
-   """Changes the display text of the wind slider"""
+def update_what_if_date_text(value):
+   """Changes the display text of the date picker"""
    return "Date shown: ({})".format(value)
 
 
@@ -389,28 +455,36 @@ def update_wind_sacle_text(value):
 
 @app.callback(
    dash.dependencies.Output('what-if-figure', 'figure'),
-   [dash.dependencies.Input('wind-scale-slider', 'value')])
+   [dash.dependencies.Input('what-if-date', 'date'),
+    dash.dependencies.Input('region', 'value')])
     #dash.dependencies.Input('hydro-scale-slider', 'value')
 
 # #@app.callback(
 #     Output('graph-with-slider', 'figure'),
 #     [Input('year-slider', 'value')])
     
-def what_if_handler(selected_year):
-    df = fetch_all_spotify_as_df(allow_cached=True)
-    x=df['date']
-
-    filtered_df = df[df.date == selected_year]
-    traces = []
-    for i in filtered_df.genre.unique():
-        df_by_genre = filtered_df[filtered_df['genre'] == i]
-        traces.append(dict(
-            x=df_by_genre['genre'],
-            y=df_by_genre['Streams'],
-            type = 'box',
-            opacity=0.7,
-            name=i
-        ))
+@metrics.timed('callback.what_if_handler')
+def what_if_handler(selected_year, region):
+    """Validates the picked date before any data is read; unparsable values leave the figure as is"""
+    if not region:
+        raise dash.exceptions.PreventUpdate
+    try:
+        selected_date = pd.Timestamp(selected_year)
+    except (ValueError, TypeError):
+        raise dash.exceptions.PreventUpdate
+    if pd.isnull(selected_date):
+        raise dash.exceptions.PreventUpdate
+    return what_if_figure(selected_date.strftime('%Y-%m-%d'), region)
+
+
+@cached_figure('what_if_figure')
+def what_if_figure(selected_date, region=DEFAULT_REGION):
+    """Returns the per-genre stream distribution of the `region` chart of `selected_date` (yyyy-mm-dd)"""
+    selected_date = pd.Timestamp(selected_date).to_pydatetime()
+    filtered_df = fetch_genre_daily_stats(selected_date, selected_date, region=region)
+    if filtered_df is None:
+        filtered_df = fetch_spotify_as_df(selected_date, selected_date, region=region)
+    traces = genre_box_traces(filtered_df, x='genre', opacity=0.7)
 
     return {
         'data': traces,
@@ -450,5 +524,40 @@ def display_page(pathname):
     else:
         return dynamic_layout()
 
+@app.server.route('/metrics')
+def metrics_endpoint():
+    """Returns the counters and latency histograms last stored by every live process (the web
+    workers as `web-<pid>` and the acquisition loop), keyed by process, as JSON
+    """
+    store_metrics()
+    return flask.jsonify(fetch_metrics(max_age=3 * METRICS_PERIOD))
+
+
+def store_metrics():
+    """Stores the metrics of this web worker in the database, where every worker's /metrics reads them"""
+    save_metrics('web-{}'.format(os.getpid()), metrics.snapshot())
+
+
+def start_metrics_thread(period=METRICS_PERIOD):
+    """Stores the metrics of this web worker every `period` seconds from a daemon thread"""
+    def loop():
+        while True:
+            time.sleep(period)
+            try:
+                store_metrics()
+            except Exception as e:
+                app.server.logger.warning("storing metrics failed: {}".format(e))
+    threading.Thread(target=loop, name='metrics', daemon=True).start()
+
+
+def warm_caches():
+    """Builds the figures of the home page so the first request of a worker finds them cached"""
+    static_stacked_trend_graph(DEFAULT_REGION, stack=True)
+    date = fetch_latest_spotify_dates(1, region=DEFAULT_REGION)
+    if len(date) > 0:
+        what_if_figure(date[0].strftime('%Y-%m-%d'), DEFAULT_REGION)
+
+
 if __name__ == '__main__':
-    app.run_server(debug=True, port=1050, host='0.0.0.0')
+    # development server; in production serve `wsgi:server` with gunicorn, see `gunicorn_conf.py`
+    app.run_server(debug=os.environ.get('DASH_DEBUG') == '1', port=1050, host='0.0.0.0')
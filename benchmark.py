@@ -0,0 +1,297 @@
+"""
+Benchmarks of the ETL and dashboard hot paths on synthetic chart histories
+
+    python benchmark.py --scales 1 10 --output before.json
+    python benchmark.py --scales 1 10 --output after.json --compare before.json
+
+Scale 1 is `BASE_DAYS` daily Top 200 charts of one region; scale k has k times as many rows,
+spread over up to `MAX_REGIONS` regions. Charts mimic the CSVs of `charts.get_chart` (a power law of
+streams by position, tracks drawn from a popularity-skewed pool), the BPA feed is `sample_data.txt`
+repeated into earlier weeks, and the Spotify Web API is replaced by a deterministic stub. Data is
+generated from `--seed`, so runs with the same arguments work on the same input.
+
+By default MongoDB is an in-memory `mongomock` client. With `--mongo-uri`, a real server is used;
+the benchmark drops its `spotify` and `energy` databases, so only point it at a scratch mongod.
+mongomock has no indexes, so its upserts grow quadratically with the data; use a real server for
+scales above 1 and for upsert timings that mean anything.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# keep the snapshot of the benchmark away from the real one; read when `snapshot` is imported
+os.environ['SPOTIFY_SNAPSHOT_DIR'] = tempfile.mkdtemp(prefix='benchmark-snapshot-')
+
+import data_acquire
+import database
+import figures
+import metrics
+import snapshot
+import metadata_cache
+from metadata_cache import MetadataCache
+
+BASE_DAYS = 7                   # chart days of one region at scale 1, the window of `update_once`
+CHART_SIZE = 200                # rows per daily chart
+MAX_REGIONS = 60
+TRACK_POOL = 2000               # tracks the charts are drawn from, per `BASE_DAYS` days
+ARTIST_POOL = 800
+GENRES = ['pop', 'dutch hip hop', 'dance pop', 'rap', 'edm', 'latin', 'rock', 'r&b', 'k-pop',
+          'tropical house', 'trap', 'indie pop', 'german hip hop', 'reggaeton', 'None']
+TOP_STREAMS = 400000            # streams of the #1 track; position p gets TOP_STREAMS * p ** -0.6
+START_DATE = pd.Timestamp('2019-01-01')
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_data.txt')
+BPA_HEADER_LINES = 12
+DEFAULT_SCALES = [1]
+DEFAULT_REPEAT = 3
+DEFAULT_SEED = 1050
+REGRESSION_THRESHOLD = 1.2      # `--compare` flags stages this many times slower than the baseline
+
+
+def _hash(text):
+    return zlib.crc32(text.encode())
+
+
+class StubSpotify:
+    """Stands in for `spotipy.Spotify`: every track has one artist and every artist a genre and a
+    follower count, all derived from the IDs. Counts the API calls.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def tracks(self, ids):
+        self.calls += 1
+        return {'tracks': [{'id': i, 'artists': [{'id': 'artist{}'.format(_hash(i) % ARTIST_POOL)}]}
+                           for i in ids]}
+
+    def artists(self, ids):
+        self.calls += 1
+        return {'artists': [{'id': i, 'genres': [GENRES[_hash(i) % len(GENRES)]],
+                             'followers': {'total': _hash(i) % 10 ** 7}} for i in ids]}
+
+
+def make_charts(scale, seed=DEFAULT_SEED):
+    """Returns the synthetic chart history of `scale` in the format `filter_spotify` reads"""
+    rng = np.random.RandomState(seed)
+    regions = ['r{:02d}'.format(i) for i in range(min(scale, MAX_REGIONS))]
+    days = BASE_DAYS * scale // len(regions)
+    dates = pd.date_range(START_DATE, periods=days, freq='D')
+    pool = TRACK_POOL * max(1, days // BASE_DAYS)
+    popularity = 1.0 / np.arange(1, pool + 1)
+    popularity /= popularity.sum()
+    positions = np.arange(1, CHART_SIZE + 1)
+    frames = []
+    for region in regions:
+        for date in dates:
+            tracks = rng.choice(pool, size=CHART_SIZE, replace=False, p=popularity)
+            streams = (TOP_STREAMS * positions ** -0.6 * rng.uniform(0.9, 1.1, CHART_SIZE)).astype(int)
+            frames.append(pd.DataFrame({
+                'Position': positions,
+                'Track Name': ['Track {}'.format(t) for t in tracks],
+                'Artist': ['Artist {}'.format(t % ARTIST_POOL) for t in tracks],
+                'Streams': np.sort(streams)[::-1],
+                'URL': ['https://open.spotify.com/track/t{:07d}'.format(t) for t in tracks],
+                'date': date.strftime('%Y-%m-%d'),
+                'region': region}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def make_bpa_text(scale, path=SAMPLE_DATA):
+    """Returns `sample_data.txt` with its week of readings repeated into `scale` consecutive weeks"""
+    with open(path) as f:
+        lines = f.read().splitlines()
+    header, body = lines[:BPA_HEADER_LINES], [line for line in lines[BPA_HEADER_LINES:] if line.strip()]
+    rows = [line.split('\t', 1) for line in body]     # the feed lists future times without readings
+    stamps = pd.to_datetime([row[0].strip() for row in rows], format=data_acquire.BPA_DATE_FORMAT)
+    week = timedelta(days=7)
+    out = list(header)
+    for i in reversed(range(scale)):
+        out.extend('\t'.join([stamp.strftime(data_acquire.BPA_DATE_FORMAT)] + row[1:])
+                   for stamp, row in zip(stamps - i * week, rows))
+    return '\n'.join(out) + '\n'
+
+
+def use_mongo(uri=None):
+    """Points `database` at the server of `uri`, or at a fresh `mongomock` client if None"""
+    if uri is None:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('mongomock is not installed; install it or pass --mongo-uri')
+        database.client = mongomock.MongoClient()
+    else:
+        import pymongo
+        database.client = pymongo.MongoClient(uri)
+
+
+def reset_state():
+    """Empties the benchmark databases and every process-level cache"""
+    for name in ('spotify', 'energy'):
+        database.client.drop_database(name)
+    database._indexes_ready = False
+    database.invalidate_spotify_cache()
+    database.invalidate_bpa_cache()
+    # fresh in-memory caches over the production collections, which were just dropped
+    data_acquire.track_cache = MetadataCache(data_acquire.track_cache.name, data_acquire.TRACK_CACHE_TTL)
+    data_acquire.artist_cache = MetadataCache(data_acquire.artist_cache.name, data_acquire.ARTIST_CACHE_TTL)
+    metrics.reset()
+
+
+def measure(func, repeat=1, setup=None):
+    """Calls `func()` `repeat` times (after `setup()`, if given) and returns the timings and the
+    value of the last call
+    """
+    seconds, value = [], None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        value = func()
+        seconds.append(time.perf_counter() - start)
+    return seconds, value
+
+
+def summarize(seconds, rows):
+    best = min(seconds)
+    return {'seconds': [round(s, 6) for s in seconds], 'min': round(best, 6),
+            'median': round(statistics.median(seconds), 6), 'rows': rows,
+            'rows_per_s': round(rows / best, 1) if best > 0 else None}
+
+
+def run_scale(scale, repeat=DEFAULT_REPEAT, seed=DEFAULT_SEED):
+    """Runs every stage on the data of `scale` against an empty database; returns
+    `{stage: summary}` plus the `metrics` breakdown recorded meanwhile
+    """
+    reset_state()
+    results = {}
+    chart = make_charts(scale, seed)
+    rows = chart.shape[0]
+
+    sp = StubSpotify()
+    seconds, df = measure(lambda: data_acquire.filter_spotify(chart.copy(), sp))
+    results['filter_spotify_cold'] = dict(summarize(seconds, rows), api_calls=sp.calls)
+    seconds, _ = measure(lambda: data_acquire.filter_spotify(chart.copy(), sp), repeat)
+    results['filter_spotify_warm'] = summarize(seconds, rows)
+
+    seconds, _ = measure(lambda: database.upsert_spotify(df))
+    results['upsert_spotify_insert'] = summarize(seconds, rows)
+    seconds, _ = measure(lambda: database.upsert_spotify(df), repeat)
+    results['upsert_spotify_update'] = summarize(seconds, rows)
+
+    seconds, full = measure(database.fetch_all_spotify_as_df, repeat, setup=database.invalidate_spotify_cache)
+    results['fetch_all_spotify_cold'] = summarize(seconds, full.shape[0])
+    seconds, full = measure(database.fetch_all_spotify_as_df, repeat)
+    results['fetch_all_spotify_incremental'] = summarize(seconds, full.shape[0])
+    seconds, _ = measure(lambda: database.fetch_all_spotify_as_df(allow_cached=True), repeat)
+    results['fetch_all_spotify_cached'] = summarize(seconds, full.shape[0])
+    if snapshot.available():
+        stored = database.fetch_spotify_days_as_df(database.fetch_spotify_days())
+        seconds, _ = measure(lambda: snapshot.write(stored))
+        results['snapshot_write'] = summarize(seconds, stored.shape[0])
+        seconds, full = measure(database.fetch_all_spotify_as_df, repeat, setup=database.invalidate_spotify_cache)
+        results['fetch_all_spotify_cold_snapshot'] = summarize(seconds, full.shape[0])
+
+    # the dashboard's reads and figures: the latest week of one region
+    region = chart['region'].iloc[0]
+    week = database.fetch_latest_spotify_dates(7, region=region)
+    seconds, stats = measure(lambda: database.fetch_genre_daily_stats(week[0], week[-1], region=region), repeat)
+    results['fetch_genre_daily_stats_week'] = summarize(seconds, stats.shape[0])
+    seconds, raw = measure(lambda: database.fetch_spotify_as_df(week[0], week[-1], region=region), repeat)
+    results['fetch_spotify_week'] = summarize(seconds, raw.shape[0])
+    seconds, _ = measure(lambda: figures.genre_box_traces(stats, x='date'), repeat)
+    results['figure_trend_from_stats'] = summarize(seconds, stats.shape[0])
+    seconds, _ = measure(lambda: figures.genre_box_traces(raw, x='date'), repeat)
+    results['figure_trend_from_rows'] = summarize(seconds, raw.shape[0])
+
+    text = make_bpa_text(scale)
+    seconds, bpa = measure(lambda: data_acquire.filter_bpa(text), repeat)
+    results['filter_bpa'] = summarize(seconds, bpa.shape[0])
+    seconds, _ = measure(lambda: database.upsert_bpa(bpa))
+    results['upsert_bpa_insert'] = summarize(seconds, bpa.shape[0])
+    seconds, _ = measure(database.fetch_all_bpa_as_df, repeat, setup=database.invalidate_bpa_cache)
+    results['fetch_all_bpa_cold'] = summarize(seconds, bpa.shape[0])
+
+    return {'rows': rows, 'stages': results, 'metrics': metrics.snapshot()['histograms']}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline, threshold=REGRESSION_THRESHOLD):
+    """Prints (to stderr) the `min` time of every stage of `current` next to `baseline`; returns the
+    `(scale, stage)` pairs at least `threshold` times slower
+    """
+    regressions = []
+    print('{:>6} {:<34} {:>11} {:>11} {:>7}'.format('scale', 'stage', 'baseline s', 'current s', 'ratio'),
+          file=sys.stderr)
+    for scale, result in current['results'].items():
+        base = baseline['results'].get(scale, {}).get('stages', {})
+        for stage, summary in result['stages'].items():
+            if stage not in base:
+                continue
+            ratio = summary['min'] / base[stage]['min'] if base[stage]['min'] > 0 else float('inf')
+            flag = ' <-' if ratio >= threshold else ''
+            print('{:>6} {:<34} {:>11.4f} {:>11.4f} {:>7.2f}{}'.format(
+                scale, stage, base[stage]['min'], summary['min'], ratio, flag), file=sys.stderr)
+            if ratio >= threshold:
+                regressions.append((scale, stage))
+    return regressions
+
+
+def quiet_loggers():
+    for module in (database, data_acquire, snapshot, metadata_cache):
+        module.logger.setLevel('WARNING')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the ETL and dashboard hot paths.')
+    parser.add_argument('--scales', nargs='+', type=int, default=DEFAULT_SCALES,
+                        help='Data sizes to run, as multiples of scale 1 (e.g. 1 10 100).')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='Runs per repeatable stage; the minimum is compared.')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='Seed of the synthetic data.')
+    parser.add_argument('--mongo-uri', help='Scratch MongoDB server to use instead of mongomock.')
+    parser.add_argument('--output', help='File to write the JSON results to (default: stdout).')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare against.')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='Slowdown ratio reported as a regression by --compare.')
+    parser.add_argument('--verbose', action='store_true', help='Keep the INFO logs of the modules.')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        quiet_loggers()
+    use_mongo(args.mongo_uri)
+    report = {'meta': {'started_at': datetime.utcnow().isoformat(), 'revision': git_revision(),
+                       'python': platform.python_version(), 'pandas': pd.__version__,
+                       'mongo': args.mongo_uri or 'mongomock', 'seed': args.seed, 'repeat': args.repeat,
+                       'snapshot': snapshot.available()},
+              'results': {}}
+    for scale in args.scales:
+        print('scale {}x ...'.format(scale), file=sys.stderr)
+        report['results'][str(scale)] = run_scale(scale, args.repeat, args.seed)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
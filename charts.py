@@ -1,8 +1,50 @@
 import io
+import logging
+import threading
 import pandas as pd
 import requests
 import time
 import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+import downloader
+import metrics
+import utils
+
+CHART_URL = 'https://spotifycharts.com/{chart}/{region}/{freq}/{date}/download'
+MAX_WORKERS = 4                 # concurrent chart downloads
+REQUEST_RATE = 1.0              # chart downloads per second, across all workers
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'data.log')
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` acquisitions per second on average, in bursts of up to `burst`.
+    Shared by all threads of a fetch.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then takes it"""
+        with metrics.timer('charts.rate_limit_wait'):
+            self._acquire()
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
 
 
 def week_dates(date, weekday=0):
@@ -11,7 +53,8 @@ def week_dates(date, weekday=0):
     return week_start, week_end
 
 
-def get_chart(date, region='en', freq='daily', chart='top200'):
+def get_chart(date, region='en', freq='daily', chart='top200', url=CHART_URL,
+              retries=downloader.MAX_DOWNLOAD_ATTEMPT, conditional=False):
     chart = 'regional' if chart == 'top200' else 'viral'
     date = pd.to_datetime(date)
     if date.year < 2017:
@@ -21,26 +64,59 @@ def get_chart(date, region='en', freq='daily', chart='top200'):
         date = f'{start.date()}--{end.date()}'
     else:
         date = f'{date.date()}'
-    url = f'https://spotifycharts.com/{chart}/{region}/{freq}/{date}/download'
-    data = io.StringIO(requests.get(url).text)
+    url = url.format(chart=chart, region=region, freq=freq, date=date)
+    text, _ = downloader.download(url, retries=retries, conditional=conditional)
+    data = io.StringIO(text)
     try:
         df = pd.read_csv(data, skiprows=1) # Fix Spotify's Note
     except pd.errors.ParserError:
         df = None
-        print(data)
+        logger.warning('Unparsable chart {}'.format(url))
     return df
 
 
-def get_charts(start, end, region='en', freq='daily', chart='top200', sleep=1):
+def get_charts(start, end, region='en', freq='daily', chart='top200', rate=REQUEST_RATE,
+               workers=MAX_WORKERS, url=CHART_URL, retries=downloader.MAX_DOWNLOAD_ATTEMPT,
+               conditional=False):
+    """Downloads every chart between `start` and `end` for one region or a list of regions.
+    See `get_charts_for` for how the downloads are run.
+    """
     sample = 'D' if freq == 'daily' else 'W'
-    dfs = []
-    for date in tqdm.tqdm(pd.date_range(start=start, end=end, freq=sample)):
-        df = get_chart(date, region=region, freq=freq, chart=chart)
+    regions = [region] if isinstance(region, str) else list(region)
+    units = [(r, date) for r in regions
+             for date in pd.date_range(start=start, end=end, freq=sample)]
+    return get_charts_for(units, freq=freq, chart=chart, rate=rate, workers=workers, url=url,
+                          retries=retries, conditional=conditional)
+
+
+def get_charts_for(units, freq='daily', chart='top200', rate=REQUEST_RATE, workers=MAX_WORKERS,
+                   url=CHART_URL, retries=downloader.MAX_DOWNLOAD_ATTEMPT, conditional=False):
+    """Downloads the chart of every `(region, date)` pair in `units`, using up to `workers` threads
+    over the pooled `downloader` session and at most `rate` requests per second. Charts that fail
+    to download are skipped. Returns one concatenated `DataFrame`, or None if no chart could be read.
+    """
+    limiter = RateLimiter(rate)
+
+    def _fetch(unit):
+        r, date = unit
+        date = pd.to_datetime(date)
+        limiter.acquire()
+        try:
+            df = get_chart(date, region=r, freq=freq, chart=chart, url=url, retries=retries,
+                           conditional=conditional)
+        except requests.exceptions.RequestException as e:
+            logger.warning('Skipping {} {}: {}'.format(r, date.date(), e))
+            return None
         if df is not None:
-            df['region'] = region
+            df['region'] = r
             df['date'] = date
-            dfs.append(df)
-            time.sleep(sleep)
+        return df
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        dfs = [df for df in tqdm.tqdm(executor.map(_fetch, units), total=len(units))
+               if df is not None]
+    if len(dfs) == 0:
+        return None
     return pd.concat(dfs)
 
 
@@ -58,8 +134,9 @@ if __name__ == '__main__':
         help='A date defining the end day for the chart.')
     parser.add_argument(
         '--region',
-        default='global',
-        help='A region defined for the chart.')
+        nargs='+',
+        default=['global'],
+        help='One or more regions defined for the chart.')
     parser.add_argument(
         '--freq',
         choices=['daily', 'weekly'],
@@ -70,12 +147,25 @@ if __name__ == '__main__':
         choices=['top200', 'viral'],
         default='top200',
         help='The type of chart to retrieve.')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=MAX_WORKERS,
+        help='Number of charts downloaded concurrently.')
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=REQUEST_RATE,
+        help='Maximum chart downloads per second.')
     args = parser.parse_args()
     
     if args.end_date is not None:
         df = get_charts(args.start_date, args.end_date, region=args.region,
-                        freq=args.freq, chart=args.chart)
+                        freq=args.freq, chart=args.chart, rate=args.rate,
+                        workers=args.workers)
     else:
-        df = get_chart(args.start_date, region=args.region, freq=args.freq,
-                       chart=args.chart)
+        df = get_charts(args.start_date, args.start_date, region=args.region,
+                        freq=args.freq, chart=args.chart)
+    if df is None:
+        parser.exit(1, 'No chart could be downloaded\n')
     df.to_csv(args.outfile)
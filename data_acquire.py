@@ -1,81 +1,222 @@
 """
 Spotify
 """
-import time
-import tqdm
 from datetime import datetime, timedelta
-import sched
+import functools
 import pandas
 import logging
 import requests
 import charts
+import downloader
+import metrics
+import pipeline
+import scheduler
 from io import StringIO
 import spotipy
 import spotipy.util as util
 import sys
 
+import snapshot
 import utils
+from database import SPOTIFY_REGION
+from database import SPOTIFY_REGIONS
 from database import upsert_bpa
 from database import upsert_spotify
+from database import fetch_spotify_dates
+from database import ensure_genre_daily_stats
+from database import rebuild_genre_daily_stats
+from database import fetch_spotify_days
+from database import fetch_spotify_days_as_df
+from database import migrate_spotify_collection
+from database import ensure_chart_entries
+from database import fetch_backfill_checkpoints
+from database import save_backfill_checkpoint
+from database import save_metrics
+from database import METRICS_PERIOD
+from metadata_cache import MetadataCache
 
 
 BPA_SOURCE = "https://transmission.bpa.gov/business/operations/Wind/baltwg.txt"
-MAX_DOWNLOAD_ATTEMPT = 5
+BPA_COLUMNS = ['Date/Time', 'Load', 'Wind', 'Hydro', 'Fossil/Biomass', 'Nuclear']
+BPA_DATE_FORMAT = '%m/%d/%Y %H:%M'
+BPA_CHUNK_SIZE = 10000          # rows parsed and upserted together
+MAX_DOWNLOAD_ATTEMPT = downloader.MAX_DOWNLOAD_ATTEMPT
 DOWNLOAD_PERIOD = 3600         # second
+BPA_PERIOD = 300               # second, the BPA feed has 5-minute readings
+SPOTIFY_WINDOW = 7              # days of charts kept up to date by `update_once`
+BACKFILL_BATCH_DAYS = 30        # days read back together by `rebuild_snapshot`
+BACKFILL_WORKERS = 4            # (region, date) units backfilled in parallel
+ENRICH_WORKERS = 2              # threads resolving chart metadata through the Web API
+WRITE_WORKERS = 1               # threads writing enriched charts to MongoDB
+TRACK_CACHE_TTL = 30 * 86400    # second, a track's artist never changes
+ARTIST_CACHE_TTL = 7 * 86400    # second, refresh genres and followers weekly
+SPOTIFY_BATCH_SIZE = 50         # IDs per Web API `tracks`/`artists` call
+TRACK_ID_PATTERN = r'/track/(\w+)'
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'data.log')
+track_cache = MetadataCache('track_cache', TRACK_CACHE_TTL)      # track ID -> artist ID
+artist_cache = MetadataCache('artist_cache', ARTIST_CACHE_TTL)   # artist ID -> genre & followers
 
 
 def download_bpa(url=BPA_SOURCE, retries=MAX_DOWNLOAD_ATTEMPT):
     """Returns BPA text from `BPA_SOURCE` that includes power loads and resources
-    Returns None if network failed
+    Returns None if network failed, or if the source is unchanged since the last download
     """
-    text = None
-    for i in range(retries):
-        try:
-            req = requests.get(url, timeout=0.5)
-            req.raise_for_status()
-            text = req.text
-        except requests.exceptions.HTTPError as e:
-            logger.warning("Retry on HTTP Error: {}".format(e))
-    if text is None:
-        logger.error('download_bpa too many FAILED attempts')
+    try:
+        text, modified = downloader.download(url, retries=retries, conditional=True)
+    except requests.exceptions.RequestException as e:
+        logger.error('download_bpa too many FAILED attempts: {}'.format(e))
+        return None
+    if not modified:
+        logger.info('download_bpa source not modified')
+        return None
     return text
 
-def download_spotify(datetime=datetime.today(), retries=MAX_DOWNLOAD_ATTEMPT):
-    """Returns BPA text from `BPA_SOURCE` that includes power loads and resources
-    Returns None if network failed
+def missing_spotify_dates(start, end, region=SPOTIFY_REGION):
+    """Returns the daily chart dates between `start` and `end` not yet stored for `region`"""
+    start, end = pandas.to_datetime(start).normalize(), pandas.to_datetime(end).normalize()
+    stored = set(pandas.to_datetime(fetch_spotify_dates(region, start.to_pydatetime(),
+                                                        end.to_pydatetime())))
+    return [date for date in pandas.date_range(start=start, end=end, freq='D')
+            if date not in stored]
+
+
+def spotify_pipeline(units, sp=None, checkpoint=False, fetch_workers=charts.MAX_WORKERS,
+                     enrich_workers=ENRICH_WORKERS, write_workers=WRITE_WORKERS,
+                     retries=MAX_DOWNLOAD_ATTEMPT, conditional=False):
+    """Runs the `(region, date)` chart `units` through overlapping fetch, enrich and write stages
+    (see `pipeline.run_pipeline`), each with its own worker pool. Charts are downloaded with
+    `retries` attempts, as conditional GETs with `conditional`; a unit whose chart fails to download
+    or parse stays pending. With `checkpoint`, every stored unit is recorded as a completed backfill
+    unit. Returns `(stored units, stage report)`.
+    """
+    if sp is None:
+        sp = spotify_client()
+    limiter = charts.RateLimiter(charts.REQUEST_RATE)
+
+    def _fetch(unit):
+        region, date = unit
+        limiter.acquire()
+        chart = charts.get_chart(date, region=region, retries=retries, conditional=conditional)
+        if chart is None or len(chart) == 0:        # raising keeps the unit pending
+            raise ValueError('no chart rows could be read')
+        chart['region'] = region
+        chart['date'] = date
+        return unit, chart
+
+    def _enrich(item):
+        unit, chart = item
+        return unit, filter_spotify(chart, sp)
+
+    def _write(item):
+        (region, date), df = item
+        upsert_spotify(df)
+        update_snapshot(df)
+        if checkpoint:
+            save_backfill_checkpoint(region, date.to_pydatetime(), df.shape[0])
+        logger.info('stored {} {}: {} rows'.format(region, date.date(), df.shape[0]))
+        return region, date
+
+    return pipeline.run_pipeline(units, [
+        pipeline.Stage('fetch', _fetch, fetch_workers),
+        pipeline.Stage('enrich', _enrich, enrich_workers),
+        pipeline.Stage('write', _write, write_workers)])
+
+
+def backfill_spotify(start, end, region=SPOTIFY_REGION, workers=BACKFILL_WORKERS, sp=None):
+    """Downloads, enriches and stores every daily chart between `start` and `end` of `region` (one
+    or a list of regions). Each `(region, date)` unit is written as soon as it completes and then
+    checkpointed in the database, so an interrupted backfill resumes with the units still pending.
+    Up to `workers` units are downloaded in parallel. Returns the units that failed.
     """
-    chart = None
-    for i in range(retries):
-        try:
-            today = datetime.today()
-            today= today.strftime("%Y-%m-%d")
-            lastweek = datetime.today() - timedelta(days = 6)
-            lastweek = lastweek.strftime("%Y-%m-%d")
-            chart = charts.get_charts(lastweek, today,region='nl')
-        except requests.exceptions.HTTPError as e:
-            logger.warning("Retry on HTTP Error: {}".format(e))
-    if chart is None:
-        logger.error('download_bpa too many FAILED attempts')
-    return chart
+    regions = [region] if isinstance(region, str) else list(region)
+    start, end = pandas.to_datetime(start), pandas.to_datetime(end)
+    done = fetch_backfill_checkpoints(regions, start.to_pydatetime(), end.to_pydatetime())
+    units = [(r, date) for r in regions for date in missing_spotify_dates(start, end, r)
+             if (r, date) not in done]
+    logger.info('backfill {}: {} units pending between {} and {}'.format(
+        regions, len(units), start.date(), end.date()))
+    if len(units) == 0:
+        return []
+    stored, _ = spotify_pipeline(units, sp, checkpoint=True, fetch_workers=workers)
+    failed = sorted(set(units) - set(stored))
+    if failed:
+        logger.warning('backfill {} units failed, will resume: {}'.format(len(failed), failed))
+    return failed
+
+
+def update_snapshot(df):
+    """Rewrites the snapshot partitions of the chart days in `df` from the database"""
+    snapshot.write(fetch_spotify_days_as_df(df[['region', 'date']].drop_duplicates()
+                                            .itertuples(index=False)))
+
+
+def rebuild_snapshot(days_per_batch=BACKFILL_BATCH_DAYS):
+    """Rewrites the snapshot of every chart day stored in the database"""
+    days = fetch_spotify_days()
+    for i in range(0, len(days), days_per_batch):
+        snapshot.write(fetch_spotify_days_as_df(days[i:i + days_per_batch]))
+
+
+def _clean_bpa(chunk):
+    """Parses `Date/Time` with `BPA_DATE_FORMAT` and the power columns as numbers, drops the rows
+    that fail (empty cells, or the description lines of concatenated files) and fixes the dtypes
+    """
+    chunk = chunk.copy()
+    chunk['Datetime'] = pandas.to_datetime(chunk['Date/Time'].str.strip(), format=BPA_DATE_FORMAT,
+                                           errors='coerce')
+    chunk.drop(columns=['Date/Time'], inplace=True)
+    for column in BPA_COLUMNS[1:]:
+        chunk[column] = pandas.to_numeric(chunk[column], errors='coerce')
+    chunk.dropna(inplace=True)          # drop rows with empty or malformed cells
+    return chunk.astype({column: 'int64' for column in BPA_COLUMNS[1:]})
+
+
+def filter_bpa_chunks(source, chunksize=BPA_CHUNK_SIZE):
+    """Yields the rows of BPA `source` (text, or a readable text buffer such as an open file) as
+    cleaned `DataFrame`s of at most `chunksize` rows, without holding the whole feed in memory
+    """
+    if isinstance(source, str):
+        source = StringIO(source)       # use StringIO to convert string to a readable buffer
+    reader = pandas.read_csv(source, skiprows=12, delimiter='\t', header=None, names=BPA_COLUMNS,
+                             dtype=str, chunksize=chunksize, on_bad_lines='skip')
+    for chunk in reader:
+        chunk = _clean_bpa(chunk)
+        if len(chunk) > 0:
+            yield chunk
 
 
 def filter_bpa(text):
     """Converts `text` to `DataFrame`, removes empty lines and descriptions
     """
-    # use StringIO to convert string to a readable buffer
-    df = pandas.read_csv(StringIO(text), skiprows=11, delimiter='\t')
-    df.columns = df.columns.str.strip()             # remove space in columns name
-    df['Datetime'] = pandas.to_datetime(df['Date/Time'])
-    df.drop(columns=['Date/Time'], axis=1, inplace=True)
-    df.dropna(inplace=True)             # drop rows with empty cells
-    return df
+    chunks = list(filter_bpa_chunks(text))
+    if len(chunks) == 0:
+        return pandas.DataFrame(columns=BPA_COLUMNS[1:] + ['Datetime'])
+    return pandas.concat(chunks, ignore_index=True)
 
-def filter_spotify(chart):
-    """append genre information to the data 
-    """
 
+def _load_bpa_buffer(buffer, chunksize):
+    rows = 0
+    for chunk in filter_bpa_chunks(buffer, chunksize):
+        upsert_bpa(chunk)
+        rows += chunk.shape[0]
+    return rows
+
+
+def load_bpa(source, chunksize=BPA_CHUNK_SIZE):
+    """Streams BPA `source` (a local file path or a URL) into the database one chunk at a time"""
+    if source.startswith(('http://', 'https://')):
+        with downloader.open_stream(source) as buffer:
+            rows = _load_bpa_buffer(buffer, chunksize)
+    else:
+        with open(source) as buffer:
+            rows = _load_bpa_buffer(buffer, chunksize)
+    logger.info("load_bpa {} rows from {}".format(rows, source))
+
+
+def spotify_client():
+    """Returns an authenticated `spotipy.Spotify` client
+    """
     ### get spotify token 
 # define authentication
     username = 'zhiyanwang27'
@@ -92,52 +233,165 @@ def filter_spotify(chart):
                                    client_secret=CLIENT_SECRET,
                                    redirect_uri='http://localhost/8000/')
 
-    sp = spotipy.Spotify(auth=token)
-    # use IO to convert it into dataframe 
+    return spotipy.Spotify(auth=token)
+
+
+def _batches(items, size=SPOTIFY_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def resolve_track_artists(sp, track_ids):
+    """Returns `{track ID: artist ID}` for the unique `track_ids`; cache misses are resolved with
+    one `sp.tracks` call per `SPOTIFY_BATCH_SIZE` tracks
+    """
+    track_ids = list(dict.fromkeys(track_ids))
+    found = track_cache.get_many(track_ids)
+    fetched = {}
+    for batch in _batches([t for t in track_ids if t not in found]):
+        with metrics.timer('spotify_api.tracks'):
+            tracks = sp.tracks(batch)['tracks']
+        for track_id, track in zip(batch, tracks):
+            if track is not None:
+                fetched[track_id] = track['artists'][0]['id']
+    track_cache.put_many(fetched)
+    found.update(fetched)
+    return found
+
+
+def resolve_artist_info(sp, artist_ids):
+    """Returns `{artist ID: {'genre': ..., 'followers': ...}}` for the unique `artist_ids`; cache
+    misses are resolved with one `sp.artists` call per `SPOTIFY_BATCH_SIZE` artists
+    """
+    artist_ids = list(dict.fromkeys(artist_ids))
+    found = artist_cache.get_many(artist_ids)
+    fetched = {}
+    for batch in _batches([a for a in artist_ids if a not in found]):
+        with metrics.timer('spotify_api.artists'):
+            artists = sp.artists(batch)['artists']
+        for artist_id, artist in zip(batch, artists):
+            if artist is not None:
+                fetched[artist_id] = {
+                    'genre': artist['genres'][0] if len(artist['genres']) > 0 else 'None',
+                    'followers': artist['followers']['total']}
+    artist_cache.put_many(fetched)
+    found.update(fetched)
+    return found
+
+
+@metrics.timed('acquire.filter_spotify')
+def filter_spotify(chart, sp=None):
+    """append genre information to the data 
+    Track and artist metadata is resolved once per unique ID for the whole chart, then joined back;
+    `follwers` comes out as int64 and `genre` as a categorical.
+    `sp` defaults to a client from `spotify_client`; anything with `tracks`/`artists` methods works.
+    """
+    if sp is None:
+        sp = spotify_client()
     df = chart
     df['date'] = pandas.to_datetime(df['date'])
-    df['ID'] = 'default value'
-    df['genre'] = 'default value'
-    df['follwers'] = 'default value'
-    for i in tqdm.tqdm(range(df.shape[0])):
-        track_id = df.iloc[i,4][31:]
-        df.iloc[i,7] = track_id
-        artist_id = sp.track(track_id)['artists'][0]['id']
-        if len(sp.artist(artist_id)['genres']) > 0:
-            gr = sp.artist(artist_id)['genres'][0]
-        else:
-            gr = 'None'
-        fl = sp.artist(artist_id)['followers']['total']
-        df.iloc[i,8] = gr
-        df.iloc[i,9] = fl
-        time.sleep(0.01)
+    df['ID'] = df['URL'].str.extract(TRACK_ID_PATTERN, expand=False)
+    track_artists = resolve_track_artists(sp, df['ID'].dropna())
+    artist_info = resolve_artist_info(sp, track_artists.values())
+    tracks = pandas.Series(track_artists, name='artist_id', dtype=object)
+    artists = pandas.DataFrame.from_dict(artist_info, orient='index', columns=['genre', 'followers'])
+    meta = tracks.to_frame().join(artists, on='artist_id')
+    df = df.join(meta[['genre', 'followers']].rename(columns={'followers': 'follwers'}), on='ID')
+    df['genre'] = df['genre'].fillna('None').astype('category')
+    df['follwers'] = df['follwers'].fillna(0).astype('int64')
+    logger.info("track cache {}, artist cache {}".format(track_cache.stats(), artist_cache.stats()))
     return df
 
 
-# def update_once():
-#     t = download_bpa()
-#     df = filter_bpa(t)
-#     upsert_bpa(df)
-def update_once():
-    t = download_spotify()
-    df = filter_spotify(t)
-    upsert_spotify(df)
+@metrics.timed('acquire.update_once')
+def update_once(region=SPOTIFY_REGION):
+    """Stores the charts of the last `SPOTIFY_WINDOW` days of `region` missing from the database"""
+    today = pandas.Timestamp.today().normalize()
+    dates = missing_spotify_dates(today - timedelta(days=SPOTIFY_WINDOW - 1), today, region)
+    if len(dates) == 0:
+        logger.info('update_once {} is up to date'.format(region))
+        return
+    spotify_pipeline([(region, date) for date in dates], conditional=True)
 
-def main_loop(timeout=DOWNLOAD_PERIOD):
-    scheduler = sched.scheduler(time.time, time.sleep)
 
-    def _worker():
-        try:
-            update_once()
-        except Exception as e:
-            logger.warning("main loop worker ignores exception and continues: {}".format(e))
-        scheduler.enter(timeout, 1, _worker)    # schedule the next event
+@metrics.timed('acquire.update_bpa_once')
+def update_bpa_once():
+    """Stores the BPA feed, unless it is unchanged since the last download"""
+    t = download_bpa()
+    if t is None:
+        return
+    upsert_bpa(filter_bpa(t))
 
-    scheduler.enter(0, 1, _worker)              # start the first event
-    scheduler.run(blocking=True)
+
+def store_metrics():
+    """Stores the metrics of this process in the database, where the app's /metrics reads them"""
+    save_metrics('acquisition', metrics.snapshot())
+
+
+def main_loop(timeout=DOWNLOAD_PERIOD, bpa_timeout=BPA_PERIOD, regions=SPOTIFY_REGIONS):
+    """Refreshes the charts of every region in `regions` every `timeout` seconds and the BPA feed
+    every `bpa_timeout` seconds, as independent jobs of an asyncio `scheduler`. The region jobs are
+    spread evenly over the period so their downloads do not all start together. The loop's metrics
+    are stored every `METRICS_PERIOD` seconds.
+    """
+    ensure_chart_entries()
+    ensure_genre_daily_stats()
+    jobs = [scheduler.Job('spotify-{}'.format(region), functools.partial(update_once, region),
+                          timeout, delay=i * timeout / len(regions))
+            for i, region in enumerate(regions)]
+    jobs.append(scheduler.Job('bpa', update_bpa_once, bpa_timeout))
+    jobs.append(scheduler.Job('metrics', store_metrics, METRICS_PERIOD, delay=METRICS_PERIOD))
+    scheduler.run(jobs)
 
 
 if __name__ == '__main__':
-    main_loop()
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'command', nargs='?',
+        choices=['loop', 'backfill', 'rebuild-stats', 'rebuild-snapshot', 'migrate-schema',
+                 'load-bpa'],
+        default='loop',
+        help='Keep the latest charts updated (default), backfill a historical range, '
+             'recompute the per-day genre statistics or the columnar snapshot, copy the '
+             'legacy `spotify` collection into `tracks` and `chart_entries`, or stream a BPA '
+             'file or URL into the database.')
+    parser.add_argument(
+        '--start_date',
+        help='First day of the backfill range.')
+    parser.add_argument(
+        '--end_date',
+        default=datetime.today().strftime('%Y-%m-%d'),
+        help='Last day of the backfill range.')
+    parser.add_argument(
+        '--region',
+        nargs='+',
+        default=SPOTIFY_REGIONS,
+        help='Regions of the charts to backfill (default: $SPOTIFY_REGIONS).')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=BACKFILL_WORKERS,
+        help='Number of chart days downloaded in parallel.')
+    parser.add_argument(
+        '--source',
+        default=BPA_SOURCE,
+        help='BPA file or URL to load.')
+    args = parser.parse_args()
+
+    if args.command == 'backfill':
+        if args.start_date is None:
+            parser.error('backfill requires --start_date')
+        backfill_spotify(args.start_date, args.end_date, region=args.region, workers=args.workers)
+    elif args.command == 'rebuild-stats':
+        rebuild_genre_daily_stats()
+    elif args.command == 'rebuild-snapshot':
+        rebuild_snapshot()
+    elif args.command == 'migrate-schema':
+        migrate_spotify_collection()
+    elif args.command == 'load-bpa':
+        load_bpa(args.source)
+    else:
+        main_loop()
 
 
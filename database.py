@@ -1,49 +1,406 @@
+import json
 import logging
+import os
+import threading
+from datetime import datetime, timedelta
 import pymongo
+from bson import Int64, ObjectId
 import pandas as pds
 import expiringdict
 
+import metrics
+import snapshot
 import utils
 
 client = pymongo.MongoClient()
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'db.log')
 RESULT_CACHE_EXPIRATION = 3600            # seconds
+BULK_CHUNK_SIZE = 1000                    # documents per bulk_write call
+WATERMARK_OVERLAP = 60                    # seconds of inserts re-read by incremental refreshes
+TREND_FIELDS = ('date', 'genre', 'Streams')   # fields plotted by the dashboard
+STATS_QUANTILES = {'q1': 0.25, 'median': 0.5, 'q3': 0.75}   # `Streams` quantiles per genre and day
+STATS_REBUILD_DAYS = 100                  # chart days recomputed per query by `rebuild_genre_daily_stats`
+METRICS_PERIOD = 60                       # seconds between the metrics snapshots each process stores
+TRACK_QUERY_CHUNK = 10000                 # track IDs per `$in` query when rejoining chart entries
+TRACK_URL = 'https://open.spotify.com/track/'
+SPOTIFY_REGION = 'nl'
+# regions kept up to date by the acquisition loop, e.g. SPOTIFY_REGIONS=nl,de,us; the first one is
+# shown by default on the dashboard
+SPOTIFY_REGIONS = [r.strip() for r in os.environ.get('SPOTIFY_REGIONS', SPOTIFY_REGION).split(',')
+                   if r.strip()]
+# chart data is stored normalized: `chart_entries` holds one small document per chart row and
+# `tracks` one document per track; these map their fields to the columns of the rejoined frames
+ENTRY_COLUMNS = {'date': 'date', 'region': 'region', 'position': 'Position', 'track': 'ID',
+                 'streams': 'Streams'}
+TRACK_COLUMNS = {'name': 'Track Name', 'artist': 'Artist', 'genre': 'genre', 'followers': 'follwers'}
+ENTRY_KEYS = ['region', 'date', 'track', 'position']   # identify a chart row across regions
+UPDATED_AT_COLLECTIONS = [('energy', 'energy'), ('spotify', 'chart_entries'), ('spotify', 'tracks')]
+_indexes_ready = False
 
 
-def upsert_bpa(df):
+def _bulk_upsert(collection, df, keys, chunk_size=BULK_CHUNK_SIZE, int64_fields=()):
+    """Replaces (or inserts) every row of `df` in `collection` using unordered bulk writes.
+    Documents are located by the fields in `keys`; `int64_fields` are always stored as 64-bit
+    integers. Every written document gets `updated_at`, which incremental readers use to find
+    documents replaced in place. Returns `(update_count, insert_count)`.
+    """
+    update_count, insert_count = 0, 0
+    records = df.to_dict('records')
+    now = datetime.utcnow()
+    for record in records:
+        for field in int64_fields:
+            record[field] = Int64(record[field])
+        record['updated_at'] = now
+    for start in range(0, len(records), chunk_size):
+        operations = [pymongo.ReplaceOne(filter={k: record[k] for k in keys},  # locate the document if exists
+                                         replacement=record,                   # latest document
+                                         upsert=True)                          # update if exists, insert if not
+                      for record in records[start:start + chunk_size]]
+        result = collection.bulk_write(operations, ordered=False)
+        update_count += result.matched_count
+        insert_count += result.upserted_count
+    return update_count, insert_count
+
+
+def ensure_indexes():
+    """Creates the unique indexes backing the upsert filters, so each lookup is an index hit.
+    Only runs once per process; MongoDB ignores indexes that already exist.
+    """
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    client.get_database("energy").get_collection("energy").create_index(
+        [('Datetime', pymongo.ASCENDING)], unique=True)
+    for db_name, collection_name in UPDATED_AT_COLLECTIONS:    # incremental refresh queries
+        client.get_database(db_name).get_collection(collection_name).create_index(
+            [('updated_at', pymongo.ASCENDING)])
+    entries = client.get_database("spotify").get_collection("chart_entries")
+    entries.create_index(
+        [('region', pymongo.ASCENDING), ('date', pymongo.ASCENDING), ('track', pymongo.ASCENDING),
+         ('position', pymongo.ASCENDING)], unique=True)   # its prefixes serve per-region reads
+    entries.create_index([('date', pymongo.ASCENDING)])     # date-only queries across regions
+    client.get_database("spotify").get_collection("genre_daily_stats").create_index(
+        [('region', pymongo.ASCENDING), ('date', pymongo.ASCENDING), ('genre', pymongo.ASCENDING)],
+        unique=True)
+    client.get_database("spotify").get_collection("backfill_checkpoints").create_index(
+        [('region', pymongo.ASCENDING), ('date', pymongo.ASCENDING)], unique=True)
+    _indexes_ready = True
+
+
+@metrics.timed('db.upsert_bpa')
+def upsert_bpa(df, chunk_size=BULK_CHUNK_SIZE):
     """
     Update MongoDB database `energy` and collection `energy` with the given `DataFrame`.
     """
+    ensure_indexes()
     db = client.get_database("energy")
     collection = db.get_collection("energy")
-    update_count = 0
-    for record in df.to_dict('records'):
-        result = collection.replace_one(
-            filter={'Datetime': record['Datetime']},    # locate the document if exists
-            replacement=record,                         # latest document
-            upsert=True)                                # update if exists, insert if not
-        if result.matched_count > 0:
-            update_count += 1
+    update_count, insert_count = _bulk_upsert(collection, df, ['Datetime'], chunk_size)
+    metrics.inc('db.upsert_bpa.rows', df.shape[0])
     logger.info("rows={}, update={}, ".format(df.shape[0], update_count) +
-                "insert={}".format(df.shape[0]-update_count))
+                "insert={}".format(insert_count))
 
-def upsert_spotify(df):
+@metrics.timed('db.upsert_spotify')
+def upsert_spotify(df, chunk_size=BULK_CHUNK_SIZE):
     """
-    Update MongoDB database 'spotify' and collection 'spotify' with the given 'DataFrame'. 
+    Update MongoDB database 'spotify' with the given 'DataFrame': track metadata goes to collection
+    'tracks' and one small document per chart row to collection 'chart_entries'.
     """
+    ensure_indexes()
     db = client.get_database("spotify")
-    collection = db.get_collection("spotify")
-    update_count = 0
-    for record in df.to_dict('records'):
-        result = collection.replace_one(
-            filter={'date': record['date'],'ID':record['ID'],'Position':record['Position']},    # locate the document if exists
-            replacement=record,                         # latest document
-            upsert=True)                                # update if exists, insert if not
-        if result.matched_count > 0:
-            update_count += 1
+    if df['ID'].isnull().any():
+        logger.warning("dropping {} rows without track ID".format(df['ID'].isnull().sum()))
+        df = df.dropna(subset=['ID'])
+    tracks = df.drop_duplicates('ID')[['ID'] + list(TRACK_COLUMNS.values())]
+    tracks = tracks.rename(columns=dict({v: k for k, v in TRACK_COLUMNS.items()}, ID='_id'))
+    tracks['genre'] = tracks['genre'].astype(str)
+    tracks['followers'] = pds.to_numeric(tracks['followers'], errors='coerce').fillna(0)
+    tracks = _changed_tracks(tracks)
+    _bulk_upsert(db.get_collection("tracks"), tracks, ['_id'], chunk_size, int64_fields=['followers'])
+    entries = df[list(ENTRY_COLUMNS.values())].rename(columns={v: k for k, v in ENTRY_COLUMNS.items()})
+    entries['position'] = entries['position'].astype(int)
+    update_count, insert_count = _bulk_upsert(db.get_collection("chart_entries"), entries,
+                                              ENTRY_KEYS, chunk_size,
+                                              int64_fields=['streams'])
+    metrics.inc('db.upsert_spotify.rows', df.shape[0])
     logger.info("rows={}, update={}, ".format(df.shape[0], update_count) +
-                "insert={}".format(df.shape[0]-update_count))
+                "insert={}, tracks={}".format(insert_count, tracks.shape[0]))
+    update_genre_daily_stats(df[['region', 'date']].drop_duplicates().itertuples(index=False))
+    bump_data_version(df['region'].unique())
+
+
+def _changed_tracks(tracks):
+    """Returns the rows of `tracks` (`tracks` documents as a DataFrame) that are not stored yet or
+    differ from the stored document, so unchanged tracks keep their `updated_at`
+    """
+    fields = list(TRACK_COLUMNS)
+    stored = _fetch_tracks(tracks['_id'].tolist(), fields).rename(
+        columns={v: k for k, v in TRACK_COLUMNS.items()}).reindex(tracks['_id'])
+    new = tracks.set_index('_id')[fields]
+    same = ((new == stored[fields]) | (new.isnull() & stored[fields].isnull())).all(axis=1)
+    return tracks[~same.values]
+
+
+def _fetch_tracks(ids, fields):
+    """Returns the `fields` (`tracks` field names) of the tracks in `ids` as a DataFrame indexed by
+    `ID`, with its columns renamed through `TRACK_COLUMNS`
+    """
+    collection = client.get_database("spotify").get_collection("tracks")
+    projection = {field: 1 for field in fields}
+    data = []
+    for start in range(0, len(ids), TRACK_QUERY_CHUNK):
+        data.extend(collection.find({'_id': {'$in': ids[start:start + TRACK_QUERY_CHUNK]}}, projection))
+    df = pds.DataFrame.from_records(data, columns=['_id'] + list(fields))
+    return df.rename(columns=dict(TRACK_COLUMNS, _id='ID')).set_index('ID')
+
+
+def _join_tracks(entries, track_fields=tuple(TRACK_COLUMNS)):
+    """Renames `chart_entries` documents in `entries` to chart columns and joins in `track_fields`"""
+    df = entries.rename(columns=ENTRY_COLUMNS)
+    if len(track_fields) > 0:
+        df = df.join(_fetch_tracks(df['ID'].unique().tolist(), track_fields), on='ID')
+    return df
+
+
+def _load_spotify(query, fields=None, with_id=False):
+    """Returns the chart entries matching `query` rejoined with their tracks, with the columns of
+    `data_acquire.filter_spotify` (`URL` rebuilt from the track ID), or only `fields` if given.
+    Only the entry and track fields needed for `fields` are read. None if nothing matches.
+    """
+    entry_fields = [k for k, v in ENTRY_COLUMNS.items() if fields is None or v in fields]
+    track_fields = [k for k, v in TRACK_COLUMNS.items() if fields is None or v in fields]
+    if len(track_fields) > 0 and 'track' not in entry_fields:
+        entry_fields.append('track')
+    projection = dict({field: 1 for field in entry_fields}, _id=1 if with_id else 0)
+    collection = client.get_database("spotify").get_collection("chart_entries")
+    data = list(collection.find(query, projection))
+    logger.info(str(len(data)) + ' documents read from the db')
+    if len(data) == 0:
+        return None
+    df = _join_tracks(pds.DataFrame.from_records(data), track_fields)
+    if fields is None:
+        df['URL'] = TRACK_URL + df['ID']
+        return df
+    return df[(['_id'] if with_id else []) + list(fields)]
+
+
+def migrate_spotify_collection(days_per_batch=STATS_REBUILD_DAYS):
+    """Copies the legacy one-document-per-row `spotify` collection into `tracks` and `chart_entries`"""
+    legacy = client.get_database("spotify").get_collection("spotify")
+    days = [(day['_id']['region'], day['_id']['date']) for day in legacy.aggregate(
+        [{'$group': {'_id': {'region': '$region', 'date': '$date'}}}])]
+    for start in range(0, len(days), days_per_batch):
+        batch = [{'region': region, 'date': date} for region, date in days[start:start + days_per_batch]]
+        upsert_spotify(pds.DataFrame.from_records(list(legacy.find({'$or': batch}, {'_id': 0}))))
+    logger.info("migrated {} chart days".format(len(days)))
+
+
+def ensure_chart_entries():
+    """Migrates the legacy `spotify` collection if `chart_entries` is empty and it is not"""
+    db = client.get_database("spotify")
+    if (db.get_collection("chart_entries").estimated_document_count() == 0 and
+            db.get_collection("spotify").estimated_document_count() > 0):
+        migrate_spotify_collection()
+
+
+def bump_data_version(regions):
+    """Increments the chart data version of each of `regions`; caches keyed by it become stale"""
+    meta = client.get_database("spotify").get_collection("meta")
+    for region in regions:
+        meta.update_one({'_id': 'data_version:' + region}, {'$inc': {'version': 1}}, upsert=True)
+
+
+def fetch_data_version(region):
+    """Returns the version of the chart data of `region`, bumped by every `upsert_spotify` of it"""
+    doc = client.get_database("spotify").get_collection("meta").find_one({'_id': 'data_version:' + region})
+    return 0 if doc is None else doc['version']
+
+
+def save_metrics(process, snapshot):
+    """Stores the `metrics.snapshot()` of `process`, so that other processes can report it"""
+    client.get_database("spotify").get_collection("metrics").replace_one(
+        {'_id': process}, {'_id': process, 'snapshot': json.dumps(snapshot),
+                           'saved_at': datetime.utcnow()}, upsert=True)
+
+
+def fetch_metrics(max_age=None):
+    """Returns the last metrics snapshot stored by each process, keyed by process name; with
+    `max_age` (seconds), only those of processes that stored one since then
+    """
+    collection = client.get_database("spotify").get_collection("metrics")
+    query = {} if max_age is None else {'saved_at': {'$gte': datetime.utcnow() - timedelta(seconds=max_age)}}
+    return {doc['_id']: json.loads(doc['snapshot']) for doc in collection.find(query)}
+
+
+def _genre_stats(df):
+    """Returns count, sum, min, max and `STATS_QUANTILES` of `Streams` per (region, date, genre)"""
+    grouped = df.groupby(['region', 'date', 'genre'])['Streams']
+    stats = grouped.agg(['count', 'sum', 'min', 'max'])
+    quantiles = grouped.quantile(list(STATS_QUANTILES.values())).unstack()
+    quantiles.columns = list(STATS_QUANTILES.keys())
+    return stats.join(quantiles).reset_index()
+
+
+def update_genre_daily_stats(days):
+    """Recomputes the `genre_daily_stats` documents of every `(region, date)` pair in `days` from
+    the chart rows stored for that day
+    """
+    db = client.get_database("spotify")
+    days = [{'region': region, 'date': date} for region, date in days]
+    if len(days) == 0:
+        return
+    data = _load_spotify({'$or': days}, fields=['region', 'date', 'genre', 'Streams'])
+    stats = db.get_collection("genre_daily_stats")
+    stats.delete_many({'$or': days})
+    if data is not None:
+        df = _genre_stats(data)
+        stats.insert_many(df.to_dict('records'))
+        logger.info("{} genre stats for {} days".format(df.shape[0], len(days)))
+
+
+def rebuild_genre_daily_stats():
+    """Recomputes `genre_daily_stats` for every stored chart day"""
+    days = fetch_spotify_days()
+    for start in range(0, len(days), STATS_REBUILD_DAYS):
+        update_genre_daily_stats(days[start:start + STATS_REBUILD_DAYS])
+
+
+def ensure_genre_daily_stats():
+    """Builds `genre_daily_stats` from the stored charts if it is empty"""
+    db = client.get_database("spotify")
+    if (db.get_collection("genre_daily_stats").estimated_document_count() == 0 and
+            db.get_collection("chart_entries").estimated_document_count() > 0):
+        rebuild_genre_daily_stats()
+
+def fetch_metadata(name, keys, min_fetched_at):
+    """Returns `{key: (value, fetched_at)}` for the entries of metadata cache collection `name` whose
+    key is in `keys` and that were fetched after `min_fetched_at`. Marks the returned entries as used.
+    """
+    collection = client.get_database("spotify").get_collection(name)
+    keys = list(keys)
+    if len(keys) == 0:
+        return {}
+    found = {doc['_id']: (doc['value'], doc['fetched_at']) for doc in collection.find(
+        {'_id': {'$in': keys}, 'fetched_at': {'$gte': min_fetched_at}}, {'value': 1, 'fetched_at': 1})}
+    if found:
+        collection.update_many({'_id': {'$in': list(found)}},
+                               {'$set': {'used_at': datetime.utcnow()}})
+    return found
+
+
+def upsert_metadata(name, mapping, max_len):
+    """Stores `{key: value}` in metadata cache collection `name`, then evicts the least recently
+    used entries beyond `max_len`.
+    """
+    collection = client.get_database("spotify").get_collection(name)
+    if len(mapping) == 0:
+        return
+    now = datetime.utcnow()
+    collection.create_index([('used_at', pymongo.ASCENDING)])
+    collection.bulk_write([pymongo.ReplaceOne({'_id': key},
+                                              {'value': value, 'fetched_at': now, 'used_at': now},
+                                              upsert=True)
+                           for key, value in mapping.items()], ordered=False)
+    excess = collection.estimated_document_count() - max_len
+    if excess > 0:
+        stale = [doc['_id'] for doc in
+                 collection.find({}, {'_id': 1}).sort('used_at', pymongo.ASCENDING).limit(excess)]
+        collection.delete_many({'_id': {'$in': stale}})
+        logger.info("{}: evicted {} entries".format(name, len(stale)))
+
+
+def fetch_spotify_dates(region, start, end):
+    """Returns the chart dates between `start` and `end` (inclusive) already stored for `region`"""
+    collection = client.get_database("spotify").get_collection("chart_entries")
+    return collection.distinct('date', {'region': region, 'date': {'$gte': start, '$lte': end}})
+
+
+def fetch_spotify_regions():
+    """Returns the regions with stored chart rows, sorted"""
+    collection = client.get_database("spotify").get_collection("chart_entries")
+    return sorted(collection.distinct('region'))
+
+
+def _date_region_query(start, end, region):
+    """Returns the filter matching documents dated between `start` and `end` (inclusive, both
+    optional) of `region` (any region if None)
+    """
+    query = {}
+    if start is not None or end is not None:
+        query['date'] = {}
+        if start is not None:
+            query['date']['$gte'] = start
+        if end is not None:
+            query['date']['$lte'] = end
+    if region is not None:
+        query['region'] = region
+    return query
+
+
+def fetch_latest_spotify_dates(n=None, region=None):
+    """Returns the `n` (all if None) most recent chart dates (of `region`, if given) in ascending order"""
+    collection = client.get_database("spotify").get_collection("chart_entries")
+    dates = sorted(collection.distinct('date', {} if region is None else {'region': region}))
+    return dates if n is None else dates[-n:]
+
+
+@metrics.timed('db.fetch_spotify_as_df')
+def fetch_spotify_as_df(start=None, end=None, region=None, fields=TREND_FIELDS):
+    """Returns the chart rows dated between `start` and `end` (inclusive, both optional) of
+    `region` (all regions if None) as a DataFrame holding only `fields`; None if nothing matches.
+    Filtering and projection happen in MongoDB, so only the requested rows are transferred.
+    """
+    return _load_spotify(_date_region_query(start, end, region), fields=fields)
+
+
+def fetch_spotify_days_as_df(days):
+    """Returns every stored chart row, `_id` included, of the `(region, date)` pairs in `days`"""
+    days = [{'region': region, 'date': date} for region, date in days]
+    if len(days) == 0:
+        return None
+    return _load_spotify({'$or': days}, with_id=True)
+
+
+def fetch_spotify_days():
+    """Returns every stored `(region, date)` chart day"""
+    collection = client.get_database("spotify").get_collection("chart_entries")
+    return [(day['_id']['region'], day['_id']['date']) for day in collection.aggregate(
+        [{'$group': {'_id': {'region': '$region', 'date': '$date'}}}])]
+
+
+def fetch_backfill_checkpoints(regions, start, end):
+    """Returns the `(region, date)` backfill units of `regions` between `start` and `end` (inclusive)
+    already completed
+    """
+    collection = client.get_database("spotify").get_collection("backfill_checkpoints")
+    query = {'region': {'$in': list(regions)}, 'date': {'$gte': start, '$lte': end}}
+    return {(doc['region'], pds.Timestamp(doc['date'])) for doc in
+            collection.find(query, {'_id': 0, 'region': 1, 'date': 1})}
+
+
+def save_backfill_checkpoint(region, date, rows):
+    """Marks the backfill unit `(region, date)` as completed with `rows` chart rows stored"""
+    collection = client.get_database("spotify").get_collection("backfill_checkpoints")
+    collection.replace_one({'region': region, 'date': date},
+                           {'region': region, 'date': date, 'rows': rows,
+                            'finished_at': datetime.utcnow()},
+                           upsert=True)
+
+
+@metrics.timed('db.fetch_genre_daily_stats')
+def fetch_genre_daily_stats(start=None, end=None, region=None):
+    """Returns the `genre_daily_stats` documents dated between `start` and `end` (inclusive, both
+    optional) of `region` (all regions if None) as a DataFrame; None if nothing matches
+    """
+    collection = client.get_database("spotify").get_collection("genre_daily_stats")
+    query = _date_region_query(start, end, region)
+    data = list(collection.find(query, {'_id': 0}))
+    logger.info(str(len(data)) + ' genre stats read from the db')
+    if len(data) == 0:
+        return None
+    return pds.DataFrame.from_records(data)
+
 
 def fetch_all_bpa():
     db = client.get_database("energy")
@@ -57,60 +414,173 @@ _fetch_all_bpa_as_df_cache = expiringdict.ExpiringDict(max_len=1,
                                                        max_age_seconds=RESULT_CACHE_EXPIRATION)
 
 def fetch_all_spotify():
-    db = client.get_database("spotify")
-    collection = db.get_collection("spotify")
-    ret = list(collection.find())
-    logger.info(str(len(ret)) + ' documents read from the db')
-    return ret
+    df = _load_spotify({}, with_id=True)
+    return [] if df is None else df.to_dict('records')
 
 
 _fetch_all_spotify_as_df_cache = expiringdict.ExpiringDict(max_len=1,
                                                        max_age_seconds=RESULT_CACHE_EXPIRATION)
 
 
-def fetch_all_bpa_as_df(allow_cached=False):
-    """Converts list of dicts returned by `fetch_all_bpa` to DataFrame with ID removed
-    Actual job is done in `_worker`. When `allow_cached`, attempt to retrieve timed cached from
-    `_fetch_all_bpa_as_df_cache`; ignore cache and call `_work` if cache expires or `allow_cached`
-    is False.
-    """
-    def _work():
-        data = fetch_all_bpa()
-        if len(data) == 0:
+class _IncrementalFrame:
+    """DataFrame mirror of a collection that is refreshed by reading only the documents inserted or
+    replaced since the previous refresh: those with a newer ObjectId or a newer `updated_at` (set
+    by `_bulk_upsert`, as upserts keep the `_id` of matched documents). The watermark is the newest
+    of both seen, minus `WATERMARK_OVERLAP` seconds to tolerate clock skew between writers; re-read
+    documents replace their cached rows. `rejoin(frame, since)`, if given, returns the cached
+    frame with the data joined in from other collections that changed after `since` brought up to
+    date, so the documents themselves need not be read again.
+    A full load first tries `cold_loader`, whose frame must hold `_id` as hex strings; it is only
+    used if it has as many rows as the collection. `transform`, if given, converts the frame of
+    newly read documents before it is cached.
+    """
+    def __init__(self, db_name, collection_name, cold_loader=None, transform=None, rejoin=None):
+        self.db_name = db_name
+        self.collection_name = collection_name
+        self.cold_loader = cold_loader
+        self.transform = transform
+        self.rejoin = rejoin
+        self._frame = None           # cached rows, including `_id` as hex strings
+        self._view = None            # cached rows without `_id` and `updated_at`, as returned to callers
+        self._watermark = None
+        self._lock = threading.Lock()
+
+    def _cold_load(self, collection):
+        if self.cold_loader is None:
+            return None
+        try:
+            df = self.cold_loader()
+        except Exception as e:          # the collection stays the source of truth
+            logger.warning("{} cold load failed: {}".format(self.collection_name, e))
+            return None
+        if df is None or len(df) != collection.estimated_document_count():
+            logger.info("{} cold load skipped, out of date".format(self.collection_name))
             return None
-        df = pds.DataFrame.from_records(data)
-        df.drop('_id', axis=1, inplace=True)
         return df
 
+    def _set_frame(self, frame):
+        self._frame = frame
+        self._view = frame.drop(columns=['_id', 'updated_at'], errors='ignore')
+        newest = ObjectId(frame['_id'].max()).generation_time
+        if 'updated_at' in frame.columns and frame['updated_at'].notnull().any():
+            updated = pds.Timestamp(frame['updated_at'].max())
+            updated = updated.tz_localize('UTC') if updated.tzinfo is None else updated.tz_convert('UTC')
+            newest = max(newest, updated.to_pydatetime())
+        self._watermark = newest if self._watermark is None else max(self._watermark, newest)
+
+    def refresh(self):
+        """Reads documents newer than the watermark (all documents after `invalidate`) and returns
+        the cached frame with `_id` removed, or None if the collection is empty
+        """
+        with self._lock, metrics.timer('db.refresh.' + self.collection_name):
+            collection = client.get_database(self.db_name).get_collection(self.collection_name)
+            if self._frame is None:
+                cold = self._cold_load(collection)
+                if cold is not None:
+                    self._set_frame(cold)
+            query, since = {}, None
+            if self._frame is not None:
+                since = self._watermark - timedelta(seconds=WATERMARK_OVERLAP)
+                query = {'$or': [{'_id': {'$gt': ObjectId.from_datetime(since)}},
+                                 {'updated_at': {'$gt': since}}]}
+            data = list(collection.find(query))
+            logger.info(str(len(data)) + ' documents read from the db')
+            metrics.inc('db.refresh.{}.documents'.format(self.collection_name), len(data))
+            frame = self._frame
+            if len(data) > 0:
+                new = pds.DataFrame.from_records(data)
+                new['_id'] = new['_id'].astype(str)
+                if self.transform is not None:
+                    new = self.transform(new)
+                if frame is not None:
+                    kept = frame[~frame['_id'].isin(new['_id'])]
+                    new = pds.concat([kept, new], ignore_index=True, sort=False)
+                frame = new
+            if since is not None and self.rejoin is not None:
+                frame = self.rejoin(frame, since)
+            if frame is not None and frame is not self._frame:
+                self._set_frame(frame)
+            return self._view
+
+    def invalidate(self):
+        """Drops the cached frame so the next `refresh` reloads the whole collection"""
+        with self._lock:
+            self._frame, self._view, self._watermark = None, None, None
+
+
+def _join_spotify_entries(entries):
+    df = _join_tracks(entries)
+    df['URL'] = TRACK_URL + df['ID']
+    return df
+
+
+def _rejoin_updated_tracks(frame, since):
+    """Returns `frame` (joined chart rows) with the track columns of the tracks rewritten after
+    `since` replaced by their stored values; `frame` itself if none of its tracks was
+    """
+    ids = client.get_database("spotify").get_collection("tracks").distinct(
+        '_id', {'updated_at': {'$gt': since}})
+    rows = frame['ID'].isin(ids)
+    if not rows.any():
+        return frame
+    tracks = _fetch_tracks(ids, list(TRACK_COLUMNS))
+    metrics.inc('db.refresh.tracks.rejoined', len(ids))
+    frame = frame.copy()
+    for column in tracks.columns:
+        values = frame.loc[rows, 'ID'].map(tracks[column])
+        if isinstance(frame[column].dtype, pds.CategoricalDtype):     # e.g. from the snapshot
+            added = pds.Index(values.dropna().unique()).difference(frame[column].cat.categories)
+            frame[column] = frame[column].cat.add_categories(added)
+        frame.loc[rows, column] = values
+    return frame
+
+
+_bpa_frame = _IncrementalFrame("energy", "energy")
+_spotify_frame = _IncrementalFrame("spotify", "chart_entries", cold_loader=snapshot.load,
+                                   transform=_join_spotify_entries, rejoin=_rejoin_updated_tracks)
+
+
+def invalidate_bpa_cache():
+    _bpa_frame.invalidate()
+    _fetch_all_bpa_as_df_cache.clear()
+
+
+def invalidate_spotify_cache():
+    _spotify_frame.invalidate()
+    _fetch_all_spotify_as_df_cache.clear()
+
+
+def fetch_all_bpa_as_df(allow_cached=False):
+    """Returns all BPA documents as a DataFrame with ID removed
+    When `allow_cached`, attempt to retrieve timed cached from `_fetch_all_bpa_as_df_cache`;
+    otherwise, or if the cache expired, only documents inserted since the last call are read and
+    appended. The whole collection is reloaded only after `invalidate_bpa_cache`.
+    """
     if allow_cached:
         try:
-            return _fetch_all_bpa_as_df_cache['cache']
+            ret = _fetch_all_bpa_as_df_cache['cache']
+            metrics.inc('db.fetch_all_bpa.cache_hits')
+            return ret
         except KeyError:
-            pass
-    ret = _work()
+            metrics.inc('db.fetch_all_bpa.cache_misses')
+    ret = _bpa_frame.refresh()
     _fetch_all_bpa_as_df_cache['cache'] = ret
     return ret
 
 def fetch_all_spotify_as_df(allow_cached=False):
-    """Converts list of dicts returned by `fetch_all_bpa` to DataFrame with ID removed
-    Actual job is done in `_worker`. When `allow_cached`, attempt to retrieve timed cached from
-    `_fetch_all_bpa_as_df_cache`; ignore cache and call `_work` if cache expires or `allow_cached`
-    is False.
-    """
-    def _work():
-        data = fetch_all_spotify()
-        if len(data) == 0:
-            return None
-        df = pds.DataFrame.from_records(data)
-        df.drop('_id', axis=1, inplace=True)
-        return df
-
+    """Returns all chart documents as a DataFrame with ID removed
+    When `allow_cached`, attempt to retrieve timed cached from `_fetch_all_spotify_as_df_cache`;
+    otherwise, or if the cache expired, only documents inserted since the last call are read and
+    appended. The whole collection is reloaded only after `invalidate_spotify_cache`.
+    """
     if allow_cached:
         try:
-            return _fetch_all_spotify_as_df_cache['cache']
+            ret = _fetch_all_spotify_as_df_cache['cache']
+            metrics.inc('db.fetch_all_spotify.cache_hits')
+            return ret
         except KeyError:
-            pass
-    ret = _work()
+            metrics.inc('db.fetch_all_spotify.cache_misses')
+    ret = _spotify_frame.refresh()
     _fetch_all_spotify_as_df_cache['cache'] = ret
     return ret
 
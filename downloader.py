@@ -0,0 +1,120 @@
+"""
+HTTP download layer shared by `data_acquire` and `charts`
+"""
+import contextlib
+import io
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+import metrics
+import utils
+
+MAX_DOWNLOAD_ATTEMPT = 5
+TIMEOUT = 10                    # second, per attempt
+BACKOFF_BASE = 0.5              # second, doubled after every failed attempt
+BACKOFF_MAX = 30                # second
+POOL_SIZE = 16                  # keep-alive connections per host
+VALIDATOR_CACHE_LEN = 256       # URLs whose ETag/Last-Modified and body are remembered
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'data.log')
+
+_session = None
+_session_lock = threading.Lock()
+_validators = OrderedDict()     # url -> (etag, last_modified, text)
+_validators_lock = threading.Lock()
+
+
+def get_session():
+    """Returns the process-wide `requests.Session` with a keep-alive connection pool"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _backoff(attempt):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _retryable(error):
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return False
+
+
+@metrics.timed('http.download')
+def download(url, retries=MAX_DOWNLOAD_ATTEMPT, timeout=TIMEOUT, conditional=False):
+    """Returns `(text, modified)` for `url`, retrying timeouts, connection errors and 5xx responses
+    with exponential backoff. With `conditional`, the request carries the validators of the last
+    response for `url`; on 304 Not Modified the remembered body is returned with `modified=False`.
+    Raises the last `requests.exceptions.RequestException` once `retries` attempts failed.
+    """
+    headers = {}
+    cached = None
+    if conditional:
+        with _validators_lock:
+            cached = _validators.get(url)
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+    for attempt in range(retries):
+        try:
+            req = get_session().get(url, headers=headers, timeout=timeout)
+            if req.status_code == 304 and cached is not None:
+                metrics.inc('http.not_modified')
+                return cached[2], False
+            req.raise_for_status()
+            text = req.text
+            break
+        except requests.exceptions.RequestException as e:
+            if not _retryable(e) or attempt == retries - 1:
+                raise
+            delay = _backoff(attempt)
+            logger.warning("Retry {} in {:.1f}s on {}".format(url, delay, e))
+            metrics.inc('http.retries')
+            time.sleep(delay)
+    if conditional:
+        etag, last_modified = req.headers.get('ETag'), req.headers.get('Last-Modified')
+        if etag or last_modified:
+            with _validators_lock:
+                _validators[url] = (etag, last_modified, text)
+                _validators.move_to_end(url)
+                while len(_validators) > VALIDATOR_CACHE_LEN:
+                    _validators.popitem(last=False)
+    return text, True
+
+
+@contextlib.contextmanager
+def open_stream(url, retries=MAX_DOWNLOAD_ATTEMPT, timeout=TIMEOUT):
+    """Yields the body of `url` as a text buffer read from the network as it is consumed, for
+    downloads too large to hold in memory. Connecting is retried like `download`.
+    """
+    for attempt in range(retries):
+        try:
+            req = get_session().get(url, timeout=timeout, stream=True)
+            req.raise_for_status()
+            break
+        except requests.exceptions.RequestException as e:
+            if not _retryable(e) or attempt == retries - 1:
+                raise
+            delay = _backoff(attempt)
+            logger.warning("Retry {} in {:.1f}s on {}".format(url, delay, e))
+            time.sleep(delay)
+    with req:
+        req.raw.decode_content = True           # undo gzip/deflate transfer encodings
+        yield io.TextIOWrapper(req.raw, encoding=req.encoding or 'utf-8')
@@ -0,0 +1,177 @@
+"""
+Figure cache for Dash callbacks
+"""
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import expiringdict
+
+import metrics
+import utils
+from database import fetch_data_version
+
+# '' keeps figures in-process; 'file:///path' shares them through a directory and
+# 'redis://host:port/db' through Redis, across all server workers
+FIGURE_CACHE_URL = os.environ.get('FIGURE_CACHE_URL', '')
+FIGURE_CACHE_MAX_LEN = 256               # figures kept, least recently used evicted first
+VERSION_CHECK_PERIOD = 10                # seconds between reads of the data version
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+_version_cache = expiringdict.ExpiringDict(max_len=FIGURE_CACHE_MAX_LEN, max_age_seconds=VERSION_CHECK_PERIOD)
+
+
+class MemoryBackend:
+    """In-process LRU"""
+    def __init__(self, max_len=FIGURE_CACHE_MAX_LEN):
+        self.max_len = max_len
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_len:
+                self._entries.popitem(last=False)
+
+
+class FileBackend:
+    """One pickle per figure in `path`; reads refresh the file's mtime, which orders eviction"""
+    def __init__(self, path, max_len=FIGURE_CACHE_MAX_LEN):
+        self.path = path
+        self.max_len = max_len
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        os.utime(self._file(key))
+        return value
+
+    def set(self, key, value):
+        tmp = self._file(key) + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._file(key))              # atomic, readers never see partial files
+        entries = [entry for entry in os.scandir(self.path) if entry.name.endswith('.pkl')]
+        if len(entries) > self.max_len:
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - self.max_len]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass                             # evicted by another worker
+
+
+class RedisBackend:
+    """Figures stored as Redis strings; a sorted set of last-use times orders eviction"""
+    def __init__(self, url, max_len=FIGURE_CACHE_MAX_LEN, prefix='figure:'):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.max_len = max_len
+        self.prefix = prefix
+        self.index = prefix + 'lru'
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        if value is None:
+            return None
+        self.redis.zadd(self.index, {key: time.time()})
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        pipe = self.redis.pipeline()
+        pipe.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        pipe.zadd(self.index, {key: time.time()})
+        pipe.zcard(self.index)
+        size = pipe.execute()[-1]
+        if size > self.max_len:
+            stale = self.redis.zrange(self.index, 0, size - self.max_len - 1)
+            if stale:
+                self.redis.delete(*[self.prefix + k.decode() for k in stale])
+                self.redis.zrem(self.index, *stale)
+
+
+def make_backend(url=FIGURE_CACHE_URL, max_len=FIGURE_CACHE_MAX_LEN):
+    """Returns the backend selected by `url`, falling back to `MemoryBackend` if it is unusable"""
+    try:
+        if url.startswith('redis://'):
+            return RedisBackend(url, max_len)
+        if url.startswith('file://'):
+            return FileBackend(url[len('file://'):], max_len)
+    except (ImportError, OSError) as e:
+        logger.warning("figure cache {} unavailable, using memory: {}".format(url, e))
+    return MemoryBackend(max_len)
+
+
+backend = make_backend()
+
+
+def data_version(region):
+    """Returns the chart data version of `region`, read from the database at most every
+    `VERSION_CHECK_PERIOD`
+    """
+    try:
+        return _version_cache[region]
+    except KeyError:
+        pass
+    version = fetch_data_version(region)
+    _version_cache[region] = version
+    return version
+
+
+def cached_figure(name, region_arg='region'):
+    """Decorator memoizing a figure-building function on (`name`, its arguments, the
+    `data_version` of the region passed as argument `region_arg`), so only figures of a region
+    whose data changed are rebuilt. Backend errors are logged and the figure is built as if the
+    cache missed.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            region = bound.arguments[region_arg]
+            key = repr((name, args, sorted(kwargs.items()), data_version(region)))
+            key = hashlib.sha1(key.encode()).hexdigest()
+            try:
+                value = backend.get(key)
+            except Exception as e:
+                logger.warning("figure cache get failed: {}".format(e))
+                value = None
+            if value is not None:
+                metrics.inc('figure_cache.hits')
+                return value
+            metrics.inc('figure_cache.misses')
+            with metrics.timer('figure.' + name):
+                value = func(*args, **kwargs)
+            try:
+                backend.set(key, value)
+            except Exception as e:
+                logger.warning("figure cache set failed: {}".format(e))
+            return value
+        return wrapper
+    return decorator
@@ -0,0 +1,75 @@
+"""
+Plotly traces shared by the dashboard graphs
+"""
+import pandas as pd
+
+TOP_N_GENRES = 30               # genres drawn individually; the rest are merged into `OTHER_GENRE`
+OTHER_GENRE = 'other'
+QUANTILE_COLUMNS = ['q1', 'median', 'q3']
+
+
+def _is_stats(df):
+    """True for `genre_daily_stats` rows, False for raw chart rows"""
+    return 'Streams' not in df.columns
+
+
+def _genre_rank(df):
+    """Returns the genres of `df` ordered by total streams, largest first"""
+    streams = df['Streams'] if not _is_stats(df) else df['sum']
+    return streams.groupby(df['genre'], observed=True).sum().sort_values(ascending=False).index
+
+
+def collapse_genres(df, top_n=TOP_N_GENRES):
+    """Returns `df` with every genre outside the `top_n` by total streams merged into `OTHER_GENRE`.
+    Raw chart rows are relabelled. Stats rows are merged per date: count, sum, min and max exactly,
+    quartiles as the count-weighted mean of the merged genres' quartiles.
+    """
+    if top_n is None:
+        return df
+    keep = _genre_rank(df)[:top_n]
+    is_top = df['genre'].isin(keep)
+    if is_top.all():
+        return df
+    if not _is_stats(df):
+        df = df.copy()
+        df['genre'] = df['genre'].astype(object).where(is_top, OTHER_GENRE)
+        return df
+    tail = df[~is_top]
+    grouped = tail.groupby('date')
+    other = grouped.agg({'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'})
+    weighted = tail[QUANTILE_COLUMNS].mul(tail['count'], axis=0).groupby(tail['date']).sum()
+    other = other.join(weighted.div(other['count'], axis=0)).reset_index()
+    other['genre'] = OTHER_GENRE
+    return pd.concat([df[is_top], other], ignore_index=True, sort=False)
+
+
+def genre_box_traces(df, x='date', top_n=TOP_N_GENRES, colors=None, **style):
+    """Returns one box trace (as a dict) per genre of `df`, placed at column `x`.
+    `df` holds either raw chart rows (`Streams`) or `genre_daily_stats` rows, which are drawn from
+    their precomputed quartiles. Rows are split by genre in one groupby pass; genres come out
+    ordered by total streams, with the long tail collapsed by `collapse_genres`.
+    """
+    if df is None or len(df) == 0:
+        return []
+    df = collapse_genres(df, top_n)
+    order = list(_genre_rank(df))
+    if OTHER_GENRE in order:
+        order.remove(OTHER_GENRE)
+        order.append(OTHER_GENRE)
+    groups = {genre: rows for genre, rows in df.groupby('genre', sort=False, observed=True)}
+    stats = _is_stats(df)
+    traces = []
+    for i, genre in enumerate(order):
+        rows = groups[genre]
+        trace = dict(type='box', name=genre, x=rows[x].to_numpy(), **style)
+        if stats:
+            trace.update(q1=rows['q1'].to_numpy(), median=rows['median'].to_numpy(),
+                         q3=rows['q3'].to_numpy(), lowerfence=rows['min'].to_numpy(),
+                         upperfence=rows['max'].to_numpy(),
+                         mean=(rows['sum'] / rows['count']).to_numpy())
+        else:
+            trace['y'] = rows['Streams'].to_numpy()
+        if colors:
+            trace['marker'] = {'color': colors[i % len(colors)]}
+        traces.append(trace)
+    return traces
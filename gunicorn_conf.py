@@ -0,0 +1,23 @@
+"""
+gunicorn settings for serving `wsgi:server`; every value can be overridden from the environment
+"""
+import multiprocessing
+import os
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '1050'))
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+reload = False
+preload_app = False          # each worker opens its own MongoDB connection after the fork
+
+
+def post_worker_init(worker):
+    """Warms the worker's caches once, before it accepts requests, and starts storing its metrics"""
+    from app import start_metrics_thread, warm_caches
+    start_metrics_thread()
+    try:
+        warm_caches()
+    except Exception as e:
+        worker.log.warning("cache warm-up failed, continuing cold: {}".format(e))
@@ -0,0 +1,81 @@
+"""
+Spotify metadata cache
+"""
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import metrics
+import utils
+from database import fetch_metadata
+from database import upsert_metadata
+
+CACHE_MAX_LEN = 50000            # entries kept per cache, in memory and in MongoDB
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'data.log')
+
+
+class MetadataCache:
+    """Size-bounded LRU cache of Spotify metadata persisted to MongoDB collection `name`.
+    Lookups check the in-process LRU first, then MongoDB; entries older than `ttl` seconds are
+    treated as misses so that they get fetched again. `hits` and `misses` count per-key lookups.
+    """
+    def __init__(self, name, ttl, max_len=CACHE_MAX_LEN):
+        self.name = name
+        self.ttl = ttl
+        self.max_len = max_len
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()        # key -> (value, fetched_at)
+        self._lock = threading.RLock()    # shared by the threads of a parallel backfill
+
+    def get_many(self, keys):
+        """Returns `{key: value}` for the cached subset of `keys`"""
+        with self._lock:
+            return self._get_many(keys)
+
+    def _get_many(self, keys):
+        min_fetched_at = datetime.utcnow() - timedelta(seconds=self.ttl)
+        keys = set(keys)
+        found, remote = {}, []
+        for key in keys:
+            entry = self._lru.get(key)
+            if entry is not None and entry[1] >= min_fetched_at:
+                self._lru.move_to_end(key)
+                found[key] = entry[0]
+            else:
+                remote.append(key)
+        if remote:
+            for key, (value, fetched_at) in fetch_metadata(self.name, remote, min_fetched_at).items():
+                self._remember(key, value, fetched_at)
+                found[key] = value
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        metrics.inc('metadata_cache.{}.hits'.format(self.name), len(found))
+        metrics.inc('metadata_cache.{}.misses'.format(self.name), len(keys) - len(found))
+        return found
+
+    def get(self, key):
+        """Returns the cached value of `key`, or None on a miss"""
+        return self.get_many([key]).get(key)
+
+    def put_many(self, mapping):
+        """Stores `{key: value}` in memory and in MongoDB"""
+        now = datetime.utcnow()
+        with self._lock:
+            for key, value in mapping.items():
+                self._remember(key, value, now)
+        upsert_metadata(self.name, mapping, self.max_len)
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def stats(self):
+        return {'name': self.name, 'hits': self.hits, 'misses': self.misses, 'size': len(self._lru)}
+
+    def _remember(self, key, value, fetched_at):
+        self._lru[key] = (value, fetched_at)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_len:
+            self._lru.popitem(last=False)
@@ -0,0 +1,100 @@
+"""
+In-process counters and latency histograms shared by the acquisition loop, `database` and the app
+"""
+import contextlib
+import functools
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+RESERVOIR_SIZE = 1024           # latest samples per histogram used for the percentiles
+PERCENTILES = {'p50': 0.50, 'p95': 0.95, 'p99': 0.99}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_started_at = time.time()
+
+
+class Histogram:
+    """Latency distribution in seconds: exact count, sum and max, and percentiles over the latest
+    `RESERVOIR_SIZE` samples
+    """
+    def __init__(self, size=RESERVOIR_SIZE):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=size)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        ret = {'count': self.count, 'sum': round(self.sum, 6),
+               'mean': round(self.sum / self.count, 6) if self.count else 0.0,
+               'max': round(self.max, 6)}
+        for label, q in PERCENTILES.items():
+            ret[label] = round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 6) if ordered else 0.0
+        return ret
+
+
+def inc(name, value=1):
+    """Adds `value` to the counter `name`"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    """Records one `seconds` sample in the histogram `name`"""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Times the `with` block into the histogram `name`; blocks raising also count `<name>.errors`"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc(name + '.errors')
+        raise
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator timing every call of the function into the histogram `name`"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """Returns the counters and histogram summaries of this process as a JSON-serializable dict"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {name: h.summary() for name, h in _histograms.items()}
+    return {'host': socket.gethostname(), 'pid': os.getpid(), 'taken_at': time.time(),
+            'uptime_s': round(time.time() - _started_at, 3),
+            'counters': dict(sorted(counters.items())), 'histograms': dict(sorted(histograms.items()))}
+
+
+def reset():
+    """Drops every counter and histogram"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
@@ -0,0 +1,117 @@
+"""
+Producer/consumer pipeline of worker stages connected by bounded queues
+"""
+import logging
+import queue
+import threading
+import time
+
+import metrics
+import utils
+
+QUEUE_SIZE = 4                  # items waiting between two stages
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'data.log')
+
+_DONE = object()                # end-of-input marker, one per worker of the receiving stage
+
+
+class Stage:
+    """A pipeline step running `func(item)` on `workers` threads. `func` returns the item handed to
+    the next stage, or None to drop it; exceptions are logged and drop the item.
+    """
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy = 0.0         # seconds spent in `func`, summed over workers
+        self.wait = 0.0         # seconds spent blocked on the output queue
+        self._lock = threading.Lock()
+
+    def report(self, elapsed):
+        return {'stage': self.name, 'workers': self.workers, 'in': self.items_in,
+                'out': self.items_out, 'errors': self.errors, 'busy_s': round(self.busy, 3),
+                'blocked_s': round(self.wait, 3),
+                'utilization': round(self.busy / (elapsed * self.workers), 3) if elapsed else 0.0,
+                'items_per_s': round(self.items_in / elapsed, 3) if elapsed else 0.0}
+
+
+def _run_worker(stage, inbox, outbox, finished, next_workers):
+    while True:
+        item = inbox.get()
+        if item is _DONE:
+            break
+        start = time.perf_counter()
+        try:
+            result = stage.func(item)
+        except Exception as e:
+            result = None
+            logger.warning("{} failed on {}: {}".format(stage.name, _describe(item), e))
+            metrics.inc('pipeline.{}.errors'.format(stage.name))
+            with stage._lock:
+                stage.errors += 1
+        busy = time.perf_counter() - start
+        metrics.observe('pipeline.' + stage.name, busy)
+        with stage._lock:
+            stage.items_in += 1
+            stage.busy += busy
+        if result is not None:
+            start = time.perf_counter()
+            outbox.put(result)
+            with stage._lock:
+                stage.items_out += 1
+                stage.wait += time.perf_counter() - start
+    if finished():                  # the last worker of the stage closes the next queue
+        for _ in range(next_workers):
+            outbox.put(_DONE)
+
+
+def _describe(item):
+    return item[0] if isinstance(item, tuple) else type(item).__name__
+
+
+def run_pipeline(items, stages, queue_size=QUEUE_SIZE):
+    """Feeds `items` through `stages`, each with its own worker threads and a bounded input queue, so
+    the stages overlap. Returns `(results, report)`: the items emitted by the last stage and one
+    throughput record per stage, which is also logged.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+    threads = []
+    for i, stage in enumerate(stages):
+        remaining = [stage.workers]
+        lock = threading.Lock()
+
+        def finished(remaining=remaining, lock=lock):
+            with lock:
+                remaining[0] -= 1
+                return remaining[0] == 0
+
+        next_workers = stages[i + 1].workers if i + 1 < len(stages) else 1
+        for _ in range(stage.workers):
+            threads.append(threading.Thread(
+                target=_run_worker, args=(stage, queues[i], queues[i + 1], finished, next_workers),
+                name='{}-worker'.format(stage.name), daemon=True))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for item in items:
+        queues[0].put(item)
+    for _ in range(stages[0].workers):
+        queues[0].put(_DONE)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    results = []
+    while True:
+        item = queues[-1].get()
+        if item is _DONE:
+            break
+        results.append(item)
+    report = [stage.report(elapsed) for stage in stages]
+    for record in report:
+        logger.info("pipeline {}".format(record))
+    logger.info("pipeline {} items in {:.2f}s".format(len(results), elapsed))
+    return results, report
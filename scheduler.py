@@ -0,0 +1,74 @@
+"""
+asyncio scheduler for periodic acquisition jobs
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import utils
+
+MAX_CONCURRENT_JOBS = 2         # job runs executing at the same time, across all jobs
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'data.log')
+
+
+class Job:
+    """Calls the blocking `func()` every `period` seconds, first after `delay` seconds.
+    Runs are scheduled at fixed times (`delay + k * period`), so a slow run does not push later
+    ones back; a tick that comes while the previous run is still going is skipped.
+    """
+    def __init__(self, name, func, period, delay=0):
+        self.name = name
+        self.func = func
+        self.period = period
+        self.delay = delay
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self._task = None
+
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+
+async def _execute(job, semaphore, executor):
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        start = loop.time()
+        try:
+            await loop.run_in_executor(executor, job.func)
+        except Exception as e:
+            job.failures += 1
+            metrics.inc('job.{}.failures'.format(job.name))
+            logger.warning("job {} ignores exception and continues: {}".format(job.name, e))
+        job.runs += 1
+        metrics.observe('job.' + job.name, loop.time() - start)
+        logger.info("job {} finished in {:.1f}s".format(job.name, loop.time() - start))
+
+
+async def _schedule(job, semaphore, executor):
+    loop = asyncio.get_running_loop()
+    origin = loop.time() + job.delay
+    tick = 0
+    while True:
+        await asyncio.sleep(max(0, origin + tick * job.period - loop.time()))
+        if job.running():
+            job.skipped += 1
+            metrics.inc('job.{}.skipped'.format(job.name))
+            logger.warning("job {} still running, skipping this period".format(job.name))
+        else:
+            job._task = asyncio.ensure_future(_execute(job, semaphore, executor))
+        # next tick on the fixed grid, dropping ticks missed while the loop was busy
+        tick = max(tick + 1, int((loop.time() - origin) // job.period) + 1)
+
+
+async def _run(jobs, max_concurrency):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as executor:
+        await asyncio.gather(*[_schedule(job, semaphore, executor) for job in jobs])
+
+
+def run(jobs, max_concurrency=MAX_CONCURRENT_JOBS):
+    """Runs `jobs` forever, with at most `max_concurrency` of them executing at once"""
+    asyncio.run(_run(jobs, max_concurrency))
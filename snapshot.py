@@ -0,0 +1,93 @@
+"""
+Columnar snapshot of the Spotify chart history
+
+One Parquet file per chart day at `SNAPSHOT_DIR/<region>/<yyyy-mm-dd>.parquet`, with the repetitive
+string columns dictionary-encoded. MongoDB stays the source of truth: every file is written from
+documents read back from the `spotify` collection (`_id` included, as a hex string), so the
+snapshot can be rebuilt from it at any time.
+"""
+import glob
+import logging
+import os
+
+import pandas as pds
+
+import utils
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:                 # snapshot disabled, readers fall back to MongoDB
+    pa = None
+    pq = None
+
+SNAPSHOT_DIR = os.environ.get('SPOTIFY_SNAPSHOT_DIR', 'snapshot')
+DICTIONARY_COLUMNS = ['genre', 'Artist', 'Track Name', 'region']
+INT_COLUMNS = ['Position', 'Streams', 'follwers']
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+
+def available():
+    return pa is not None
+
+
+def _normalize(df):
+    """Returns `df` with the snapshot's fixed column types"""
+    df = df.copy()
+    df['_id'] = df['_id'].astype(str)
+    df['date'] = pds.to_datetime(df['date'])
+    for column in INT_COLUMNS:
+        if column in df.columns:
+            df[column] = pds.to_numeric(df[column], errors='coerce').fillna(0).astype('int64')
+    for column in DICTIONARY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype(str).astype('category')
+    return df
+
+
+def _schema(schema):
+    """Returns `schema` with every dictionary column as `int32` indices into strings. pandas picks
+    the narrowest index type for the categories of each day, and files whose index widths differ
+    cannot be concatenated.
+    """
+    return pa.schema([pa.field(f.name, pa.dictionary(pa.int32(), pa.string()))
+                      if pa.types.is_dictionary(f.type) else f for f in schema])
+
+
+def write(df, path=SNAPSHOT_DIR):
+    """Writes (or replaces) the partition of every (region, date) in `df`, which must hold all the
+    stored rows of those days
+    """
+    if not available() or df is None or len(df) == 0:
+        return
+    df = _normalize(df)
+    for (region, date), rows in df.groupby(['region', 'date'], observed=True):
+        directory = os.path.join(path, str(region))
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, '{}.parquet'.format(date.strftime('%Y-%m-%d')))
+        table = pa.Table.from_pandas(rows.reset_index(drop=True), preserve_index=False)
+        table = table.cast(_schema(table.schema))
+        pq.write_table(table, target + '.tmp', use_dictionary=True, compression='snappy')
+        os.replace(target + '.tmp', target)      # readers never see partial files
+    logger.info("snapshot wrote {} rows".format(df.shape[0]))
+
+
+def load(path=SNAPSHOT_DIR):
+    """Returns the whole snapshot as a DataFrame (dictionary columns as categoricals), reading the
+    files through memory maps; None if there is no snapshot or it cannot be read
+    """
+    if not available():
+        return None
+    files = sorted(glob.glob(os.path.join(path, '*', '*.parquet')))
+    if len(files) == 0:
+        return None
+    try:
+        tables = [pq.read_table(f, memory_map=True) for f in files]
+        schema = _schema(tables[0].schema)      # also aligns files written before the fixed schema
+        df = pa.concat_tables([table.cast(schema) for table in tables]).to_pandas()
+    except (pa.ArrowException, OSError, ValueError) as e:
+        logger.warning("snapshot unreadable, ignored: {}".format(e))
+        return None
+    logger.info("snapshot read {} rows from {} files".format(df.shape[0], len(files)))
+    return df
@@ -4,5 +4,5 @@ set -xe
 mkdir -p /var/log;
 chmod -R 777 /var/log;
 mongod --fork --logpath=/var/log/mongodb.log;
-python3 data_acquire.py & python3 app.py;
+python3 data_acquire.py & gunicorn -c gunicorn_conf.py wsgi:server;
 #python3 -c 'import pymongo;list(pymongo.MongoClient().get_database("energy").energy.find())';
@@ -0,0 +1,76 @@
+import functools
+import http.server
+import os
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import charts
+
+CSV = """Note that these figures are generated using a formula that protects against manipulation.
+Position,Track Name,Artist,Streams,URL
+1,Song A,Artist A,300000,https://open.spotify.com/track/a
+2,Song B,Artist B,200000,https://open.spotify.com/track/b
+3,Song C,Artist C,100000,https://open.spotify.com/track/c
+"""
+
+
+@pytest.fixture
+def chart_server(tmp_path):
+    """Serves `CSV` as the daily top 200 chart of nl and de on 2019-12-01 and 2019-12-02, except de
+    on 2019-12-02, and returns the chart URL template pointing at it
+    """
+    for region, date in [('nl', '2019-12-01'), ('nl', '2019-12-02'), ('de', '2019-12-01')]:
+        directory = tmp_path / 'regional' / region / 'daily' / date
+        os.makedirs(str(directory))
+        (directory / 'download').write_text(CSV)
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(tmp_path))
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/{{chart}}/{{region}}/{{freq}}/{{date}}/download'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_chart(chart_server):
+    df = charts.get_chart('2019-12-01', region='nl', url=chart_server)
+    assert df['Position'].tolist() == [1, 2, 3]
+    assert df.columns.tolist() == ['Position', 'Track Name', 'Artist', 'Streams', 'URL']
+
+
+def test_get_charts_concatenates_regions(chart_server):
+    df = charts.get_charts('2019-12-01', '2019-12-02', region=['nl', 'de'], url=chart_server,
+                           rate=100, retries=1)
+    # de 2019-12-02 is missing (404) and skipped
+    assert df.shape[0] == 9
+    assert sorted(df.groupby(['region', 'date']).size().index.tolist()) == [
+        ('de', pd.Timestamp('2019-12-01')), ('nl', pd.Timestamp('2019-12-01')),
+        ('nl', pd.Timestamp('2019-12-02'))]
+
+
+def test_get_charts_returns_none_without_data(chart_server):
+    assert charts.get_charts('2019-12-05', '2019-12-06', region='nl', url=chart_server,
+                             rate=100, retries=1) is None
+
+
+def test_get_charts_is_rate_limited(chart_server):
+    start = time.monotonic()
+    charts.get_charts('2019-12-01', '2019-12-02', region=['nl', 'de'], url=chart_server, rate=10,
+                      workers=4, retries=1)
+    # the first request uses the initial token, the other three wait 0.1s each
+    assert time.monotonic() - start >= 0.3
+
+
+def test_rate_limiter_allows_bursts():
+    limiter = charts.RateLimiter(rate=20, burst=5)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.1
+    for _ in range(4):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.15
@@ -0,0 +1,84 @@
+import math
+
+import pandas as pd
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+import data_acquire
+import database
+from metadata_cache import MetadataCache
+
+TRACKS = 120                    # unique tracks in the chart
+ARTISTS = 70                    # unique artists of those tracks
+
+
+class CountingSpotify:
+    """Stands in for `spotipy.Spotify`: track `t<i>` is by artist `a<i % ARTISTS>`. Records the IDs
+    of every API call.
+    """
+    def __init__(self):
+        self.track_calls = []
+        self.artist_calls = []
+
+    def tracks(self, ids):
+        self.track_calls.append(list(ids))
+        return {'tracks': [{'id': i, 'artists': [{'id': 'a{}'.format(int(i[1:]) % ARTISTS)}]}
+                           for i in ids]}
+
+    def artists(self, ids):
+        self.artist_calls.append(list(ids))
+        return {'artists': [{'id': i, 'genres': ['pop'] if int(i[1:]) % 2 else [],
+                             'followers': {'total': int(i[1:])}} for i in ids]}
+
+
+@pytest.fixture(autouse=True)
+def caches(monkeypatch):
+    monkeypatch.setattr(database, 'client', mongomock.MongoClient())
+    monkeypatch.setattr(data_acquire, 'track_cache',
+                        MetadataCache('track_cache', data_acquire.TRACK_CACHE_TTL))
+    monkeypatch.setattr(data_acquire, 'artist_cache',
+                        MetadataCache('artist_cache', data_acquire.ARTIST_CACHE_TTL))
+
+
+def chart():
+    """Returns a chart of `TRACKS` unique tracks, 30 of which appear twice"""
+    tracks = list(range(TRACKS)) + list(range(30))
+    return pd.DataFrame({'Position': range(1, len(tracks) + 1),
+                         'Track Name': ['Song {}'.format(t) for t in tracks],
+                         'Artist': ['Artist {}'.format(t % ARTISTS) for t in tracks],
+                         'Streams': 1000,
+                         'URL': ['https://open.spotify.com/track/t{}'.format(t) for t in tracks],
+                         'date': '2019-12-01', 'region': 'nl'})
+
+
+def test_filter_spotify_batches_unique_ids():
+    sp = CountingSpotify()
+    df = data_acquire.filter_spotify(chart(), sp)
+
+    batch = data_acquire.SPOTIFY_BATCH_SIZE
+    assert len(sp.track_calls) == math.ceil(TRACKS / batch)
+    assert len(sp.artist_calls) == math.ceil(ARTISTS / batch)
+    assert all(len(ids) <= batch for ids in sp.track_calls + sp.artist_calls)
+    assert sorted(sum(sp.track_calls, [])) == sorted('t{}'.format(t) for t in range(TRACKS))
+    assert sorted(sum(sp.artist_calls, [])) == sorted('a{}'.format(a) for a in range(ARTISTS))
+    assert df.shape[0] == TRACKS + 30
+
+
+def test_filter_spotify_joins_metadata_with_stable_dtypes():
+    df = data_acquire.filter_spotify(chart(), CountingSpotify())
+
+    assert df['follwers'].dtype == 'int64'
+    assert isinstance(df['genre'].dtype, pd.CategoricalDtype)
+    by_id = df.drop_duplicates('ID').set_index('ID')
+    assert (by_id.loc['t71', 'genre'], by_id.loc['t71', 'follwers']) == ('pop', 1)
+    assert (by_id.loc['t100', 'genre'], by_id.loc['t100', 'follwers']) == ('None', 30)
+
+
+def test_second_run_is_served_from_the_caches():
+    data_acquire.filter_spotify(chart(), CountingSpotify())
+
+    sp = CountingSpotify()
+    df = data_acquire.filter_spotify(chart(), sp)
+
+    assert sp.track_calls == [] and sp.artist_calls == []
+    assert df['follwers'].sum() > 0
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+from bson import ObjectId
+
+mongomock = pytest.importorskip('mongomock')
+import database
+import metrics
+
+OLD = datetime.utcnow() - timedelta(days=1)
+
+
+@pytest.fixture(autouse=True)
+def mongo(monkeypatch):
+    monkeypatch.setattr(database, 'client', mongomock.MongoClient())
+    monkeypatch.setattr(database, '_indexes_ready', False)
+    monkeypatch.setattr(database, 'WATERMARK_OVERLAP', 0)
+    database.invalidate_bpa_cache()
+    database.invalidate_spotify_cache()
+
+
+def old_id(i):
+    """Returns an ObjectId generated before the first refresh of a test"""
+    return ObjectId.from_datetime(OLD - timedelta(minutes=i))
+
+
+def test_refresh_reads_documents_replaced_in_place():
+    energy = database.client.get_database('energy').get_collection('energy')
+    energy.insert_many([{'_id': old_id(i), 'Datetime': datetime(2019, 11, 17, 0, i), 'Load': 100}
+                        for i in range(3)])
+    assert database.fetch_all_bpa_as_df()['Load'].tolist() == [100, 100, 100]
+
+    database.upsert_bpa(pd.DataFrame({'Datetime': [datetime(2019, 11, 17, 0, 1)], 'Load': [150]}))
+
+    df = database.fetch_all_bpa_as_df()
+    assert df.shape[0] == 3
+    assert sorted(df['Load'].tolist()) == [100, 100, 150]
+    assert 'updated_at' not in df.columns
+
+
+def test_refresh_rejoins_entries_of_updated_tracks():
+    spotify = database.client.get_database('spotify')
+    spotify.get_collection('tracks').insert_one(
+        {'_id': 't1', 'name': 'song', 'artist': 'someone', 'genre': 'pop', 'followers': 10})
+    spotify.get_collection('chart_entries').insert_many(
+        [{'_id': old_id(i), 'region': 'nl', 'date': datetime(2019, 12, i + 1), 'position': 1,
+          'track': 't1', 'streams': 1000} for i in range(2)])
+    assert set(database.fetch_all_spotify_as_df()['genre']) == {'pop'}
+
+    tracks = pd.DataFrame({'_id': ['t1'], 'name': ['song'], 'artist': ['someone'], 'genre': ['rock'],
+                           'followers': [20]})
+    database._bulk_upsert(spotify.get_collection('tracks'), tracks, ['_id'])
+
+    df = database.fetch_all_spotify_as_df()
+    assert df.shape[0] == 2
+    assert set(df['genre']) == {'rock'}
+    assert set(df['follwers']) == {20}
+
+
+def test_refresh_reads_only_new_entries_when_tracks_are_unchanged():
+    spotify = database.client.get_database('spotify')
+    spotify.get_collection('tracks').insert_many(
+        [{'_id': 't%d' % p, 'name': 'song %d' % p, 'artist': 'someone', 'genre': 'pop',
+          'followers': 10} for p in range(20)])
+    spotify.get_collection('chart_entries').insert_many(
+        [{'_id': old_id(d * 20 + p), 'region': 'nl', 'date': datetime(2019, 11, 1) + timedelta(days=d),
+          'position': p + 1, 'track': 't%d' % p, 'streams': 1000} for d in range(30) for p in range(20)])
+    assert database.fetch_all_spotify_as_df().shape[0] == 600
+
+    database.upsert_spotify(pd.DataFrame({
+        'ID': ['t%d' % p for p in range(20)], 'Track Name': ['song %d' % p for p in range(20)],
+        'Artist': 'someone', 'genre': 'pop', 'follwers': 10, 'date': datetime(2019, 12, 1),
+        'region': 'nl', 'Position': range(1, 21), 'Streams': 1000}))
+    read = metrics.snapshot()['counters']['db.refresh.chart_entries.documents']
+
+    assert database.fetch_all_spotify_as_df().shape[0] == 620
+    assert metrics.snapshot()['counters']['db.refresh.chart_entries.documents'] - read == 20
+
+
+def test_ensure_chart_entries_migrates_the_legacy_collection():
+    spotify = database.client.get_database('spotify')
+    spotify.get_collection('spotify').insert_many(
+        [{'ID': 't%d' % p, 'Track Name': 'song %d' % p, 'Artist': 'someone', 'genre': 'pop',
+          'follwers': 10, 'date': datetime(2019, 12, 1), 'region': 'nl', 'Position': p + 1,
+          'Streams': 1000} for p in range(3)])
+
+    database.ensure_chart_entries()
+    database.ensure_chart_entries()
+
+    assert spotify.get_collection('chart_entries').count_documents({}) == 3
+    assert spotify.get_collection('tracks').count_documents({}) == 3
+    assert database.fetch_all_spotify_as_df().shape[0] == 3
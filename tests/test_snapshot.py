@@ -0,0 +1,65 @@
+import os
+
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+import pyarrow.parquet as pq
+
+import snapshot
+
+
+def chart_day(date, rows, artists):
+    """Returns `rows` stored chart rows of `date` with `artists` distinct artists"""
+    return pd.DataFrame({
+        '_id': ['{}{:04d}'.format(date.replace('-', ''), i) for i in range(rows)],
+        'date': pd.Timestamp(date),
+        'region': 'nl',
+        'Position': range(1, rows + 1),
+        'Track Name': ['track {}'.format(i) for i in range(rows)],
+        'Artist': ['artist {}'.format(i % artists) for i in range(rows)],
+        'Streams': range(rows, 0, -1),
+        'genre': 'pop',
+        'follwers': 10,
+    })
+
+
+def test_load_days_of_different_cardinality(tmp_path):
+    # 100 distinct artists fit int8 dictionary indices, 200 need int16
+    snapshot.write(pd.concat([chart_day('2019-12-01', 100, 100), chart_day('2019-12-02', 200, 200)]),
+                   path=str(tmp_path))
+    df = snapshot.load(path=str(tmp_path))
+    assert df.shape[0] == 300
+    assert df['Artist'].nunique() == 200
+    assert str(df['Artist'].dtype) == 'category'
+
+
+def test_load_files_with_different_index_widths(tmp_path):
+    # files written without the fixed schema keep the width pandas picked
+    for date, rows in [('2019-12-01', 100), ('2019-12-02', 200)]:
+        df = snapshot._normalize(chart_day(date, rows, rows))
+        os.makedirs(str(tmp_path / 'nl'), exist_ok=True)
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False),
+                       str(tmp_path / 'nl' / '{}.parquet'.format(date)))
+    df = snapshot.load(path=str(tmp_path))
+    assert df.shape[0] == 300
+
+
+def test_unreadable_snapshot_is_ignored(tmp_path):
+    os.makedirs(str(tmp_path / 'nl'))
+    (tmp_path / 'nl' / '2019-12-01.parquet').write_bytes(b'not parquet')
+    assert snapshot.load(path=str(tmp_path)) is None
+
+
+def test_cold_load_failure_falls_back_to_mongodb(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    import database
+    monkeypatch.setattr(database, 'client', mongomock.MongoClient())
+    database.client.get_database('spotify').get_collection('chart_entries').insert_many(
+        [{'date': pd.Timestamp('2019-12-01').to_pydatetime(), 'position': i} for i in range(3)])
+
+    def broken_loader():
+        raise pa.ArrowInvalid('schema mismatch')
+
+    frame = database._IncrementalFrame('spotify', 'chart_entries', cold_loader=broken_loader)
+    assert frame.refresh().shape[0] == 3
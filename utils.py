@@ -1,17 +1,127 @@
-import sys
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
 
+import metrics
 
-def setup_logger(logger, output_file):
-    logger.setLevel(logging.INFO)
+# Log records are put on one queue by the logging call and written by a single background listener
+# thread, so slow disks or terminals never stall the caller. Configured through the environment:
+LOG_QUEUE_SIZE = 10000          # records waiting to be written; further ones count as `logging.dropped`
+# rotating files are per process (`db.log` becomes `db.<pid>.log`): processes sharing one file would
+# each rotate it under the others
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 0))      # rotate files at this size (0: never)
+LOG_ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN')          # or on time, e.g. 'midnight', 'H'
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))  # rotated files kept
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')            # 'json' writes one object per line
+
+_lock = threading.Lock()
+_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_listener = None
+_router = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object"""
+    def format(self, record):
+        data = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                'func': record.funcName, 'message': record.getMessage()}
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records tagged with the file they go to, dropping them rather than blocking when
+    the listener falls behind
+    """
+    def __init__(self, output_file):
+        super().__init__(_queue)
+        self.output_file = output_file
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.output_file = self.output_file
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('logging.dropped')
 
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setFormatter(logging.Formatter('%(asctime)s [%(funcName)s]: %(message)s'))
-    logger.addHandler(stdout_handler)
 
-    file_handler = logging.FileHandler(output_file)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s [%(funcName)s] %(message)s'))
-    logger.addHandler(file_handler)
+class _Router(logging.Handler):
+    """Runs on the listener thread: writes every record to stdout and to the file it is tagged with"""
+    def __init__(self):
+        super().__init__()
+        self.stdout = logging.StreamHandler(sys.stdout)
+        self.stdout.setFormatter(_formatter('%(asctime)s [%(funcName)s]: %(message)s'))
+        self.files = {}
 
+    def add_file(self, output_file):
+        if output_file not in self.files:
+            self.files[output_file] = _file_handler(output_file)
 
+    def emit(self, record):
+        self.stdout.handle(record)
+        handler = self.files.get(getattr(record, 'output_file', None))
+        if handler is not None:
+            handler.handle(record)
 
+    def close(self):
+        for handler in [self.stdout] + list(self.files.values()):
+            handler.close()
+        super().close()
+
+
+def _formatter(text_format):
+    return JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(text_format)
+
+
+def _file_handler(output_file):
+    if LOG_ROTATE_WHEN or LOG_MAX_BYTES > 0:
+        root, ext = os.path.splitext(output_file)
+        output_file = '{}.{}{}'.format(root, os.getpid(), ext)
+    if LOG_ROTATE_WHEN:
+        handler = logging.handlers.TimedRotatingFileHandler(output_file, when=LOG_ROTATE_WHEN,
+                                                            backupCount=LOG_BACKUP_COUNT)
+    elif LOG_MAX_BYTES > 0:
+        handler = logging.handlers.RotatingFileHandler(output_file, maxBytes=LOG_MAX_BYTES,
+                                                       backupCount=LOG_BACKUP_COUNT)
+    else:
+        handler = logging.FileHandler(output_file)
+    handler.setFormatter(_formatter('%(asctime)s [%(funcName)s] %(message)s'))
+    return handler
+
+
+def _stop_listener():
+    """Writes out the queued records and stops the listener; registered to run at exit"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _router.close()
+            _listener = None
+
+
+def setup_logger(logger, output_file):
+    """Sends the INFO and above records of `logger` to stdout and `output_file` through the
+    background listener. Calling it again for the same logger and file does nothing.
+    """
+    global _listener, _router
+    logger.setLevel(logging.INFO)
+    with _lock:
+        if _listener is None:
+            _router = _Router()
+            _listener = logging.handlers.QueueListener(_queue, _router)
+            _listener.start()
+            atexit.register(_stop_listener)
+        _router.add_file(output_file)
+        if any(isinstance(h, _QueueHandler) and h.output_file == output_file for h in logger.handlers):
+            return
+        logger.addHandler(_QueueHandler(output_file))
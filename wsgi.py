@@ -0,0 +1,6 @@
+"""
+WSGI entry point, served in production with `gunicorn -c gunicorn_conf.py wsgi:server`
+"""
+from app import app
+
+server = app.server